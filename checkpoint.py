@@ -0,0 +1,152 @@
+"""
+Asynchronous, rotating training checkpoints.
+
+save() copies the state to CPU memory on the calling thread (the only part that blocks the
+training loop) and serializes it on a background thread, to a temporary file renamed into place
+once complete. The last keep_last checkpoints are kept, plus the one with the best metric.
+
+    directory/checkpoint_00001000.pth
+    directory/checkpoints.json  {"checkpoints": [{"step", "file", "metric"}, ...], "best": file}
+"""
+
+import json
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+INDEX = "checkpoints.json"
+
+
+def to_cpu(obj, memo=None):
+    """
+    Copy of a (nested dict / list / tuple of) tensors with every tensor copied to CPU. Tensors
+    viewing the same memory (e.g. tied embedding and head weights) share a single copy, so they
+    are saved once and stay tied when loaded.
+    """
+    if memo is None:
+        memo = {}
+    if isinstance(obj, torch.Tensor):
+        key = (obj.device, obj.data_ptr(), obj.dtype, tuple(obj.shape), obj.stride())
+        if key not in memo:
+            # always a copy, the training loop keeps updating the original in place
+            memo[key] = obj.detach().to("cpu", copy=True)
+        return memo[key]
+    if isinstance(obj, dict):
+        return {k: to_cpu(v, memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v, memo) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class CheckpointManager:
+    def __init__(self, directory, keep_last=3):
+        """
+        Write checkpoints to directory, keeping the keep_last most recent ones and the best one
+        (lowest metric, e.g. the eval loss). keep_last=0 only keeps the best one.
+        """
+        if keep_last < 0:
+            raise ValueError("keep_last must be >= 0")
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.keep_last = keep_last
+        self.checkpoints = []  # {"step", "file", "metric"} in the order they were saved
+        self.best = None
+        index_path = self.directory / INDEX
+        if index_path.exists():
+            index = json.loads(index_path.read_text())
+            self.checkpoints, self.best = index["checkpoints"], index["best"]
+        # metric of the best checkpoint, updated when saving rather than once it is written
+        self.best_metric = float("inf")
+        for checkpoint in self.checkpoints:
+            if checkpoint["file"] == self.best:
+                self.best_metric = checkpoint["metric"]
+        # a single writer: saves are serialized and the index is only touched by this thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def save(self, step, state, metric=None):
+        """
+        Snapshot state (a dict of state dicts, tensors and plain objects) and write it in the
+        background. Waits for the previous save to finish first, only one write is ever in flight.
+        """
+        snapshot = to_cpu(state)
+        is_best = metric is not None and metric < self.best_metric
+        if is_best:
+            self.best_metric = metric
+        self.wait()
+        self._pending = self._executor.submit(self._write, step, snapshot, metric, is_best)
+
+    def wait(self):
+        """Block until the pending save is on disk, re-raising its error if it failed."""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def _write(self, step, snapshot, metric, is_best):
+        name = f"checkpoint_{step:08d}.pth"
+        tmp_path = self.directory / (name + ".tmp")
+        torch.save(snapshot, tmp_path)
+        os.replace(tmp_path, self.directory / name)
+
+        # saving again at the same step replaces the previous entry
+        self.checkpoints = [c for c in self.checkpoints if c["file"] != name]
+        self.checkpoints.append({"step": step, "file": name, "metric": metric})
+        if is_best:
+            self.best = name
+        # not checkpoints[-keep_last:], which keeps everything for keep_last=0
+        recent = self.checkpoints[max(len(self.checkpoints) - self.keep_last, 0) :]
+        keep = {c["file"] for c in recent} | {self.best}
+        removed = [c for c in self.checkpoints if c["file"] not in keep]
+        self.checkpoints = [c for c in self.checkpoints if c["file"] in keep]
+        self._write_index()
+        # files go after the index stops listing them
+        for checkpoint in removed:
+            (self.directory / checkpoint["file"]).unlink(missing_ok=True)
+
+    def _write_index(self):
+        tmp_path = self.directory / (INDEX + ".tmp")
+        tmp_path.write_text(json.dumps({"checkpoints": self.checkpoints, "best": self.best}, indent=2))
+        os.replace(tmp_path, self.directory / INDEX)
+
+    @property
+    def latest_path(self):
+        return self.directory / self.checkpoints[-1]["file"] if self.checkpoints else None
+
+    @property
+    def best_path(self):
+        return self.directory / self.best if self.best else None
+
+    def resume_from_latest(self, map_location="cpu"):
+        """The state of the most recent checkpoint, None when there is none yet."""
+        self.wait()
+        if self.latest_path is None:
+            return None
+        return torch.load(self.latest_path, map_location=map_location, weights_only=False)
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
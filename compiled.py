@@ -0,0 +1,153 @@
+"""
+torch.compile'd MiniGPT with sequence length bucketing, and an eager vs compiled benchmark.
+
+Compiled graphs are specialized on the input shapes (dynamic=False), so inputs are right padded
+to the next bucket length: a handful of graphs cover every length, e.g. while a generated
+sequence grows. With the causal mask the padding never changes the outputs of the real positions,
+padded targets are ignored by the loss.
+
+Usage:
+    python compiled.py --checkpoint pretrained_models/best_train_loss_checkpoint.pth --mode default
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from config import MiniGPTConfig
+from model import IGNORE_INDEX, MiniGPT
+from sampling import Sampler, TokenBuffer
+
+
+def default_buckets(context_length, smallest=16):
+    """Powers of two from smallest up to context_length, and context_length itself."""
+    buckets = []
+    length = smallest
+    while length < context_length:
+        buckets.append(length)
+        length *= 2
+    return buckets + [context_length]
+
+
+def bucket_length(length, buckets):
+    for bucket in buckets:
+        if bucket >= length:
+            return bucket
+    raise ValueError(f"sequence of {length} tokens is longer than the largest bucket {buckets[-1]}")
+
+
+class CompiledMiniGPT(nn.Module):
+    def __init__(self, model, buckets=None, mode=None):
+        """
+        Args:
+        model : MiniGPT
+            The eager model, sharing its parameters with the compiled one.
+        buckets : Sequence[int], optional
+            Padded sequence lengths, default_buckets(model.context_length) by default.
+        mode : str, optional
+            torch.compile mode ("default", "reduce-overhead", "max-autotune").
+        """
+        super().__init__()
+        self.model = model
+        self.buckets = sorted(buckets or default_buckets(model.context_length))
+        self.compiled = torch.compile(model, mode=mode, dynamic=False)
+
+    def forward(self, x, targets=None):
+        """MiniGPT.forward on full sequences (no KV cache): logits, or the loss with targets."""
+        seq_len = x.size(1)
+        padding = bucket_length(seq_len, self.buckets) - seq_len
+        if padding:
+            x = F.pad(x, (0, padding))
+            if targets is not None:
+                targets = F.pad(targets, (0, padding), value=IGNORE_INDEX)
+        if targets is not None:
+            return self.compiled(x, targets=targets)
+        return self.compiled(x)[:, :seq_len]
+
+    @torch.no_grad()
+    def generate(self, context, max_new_tokens=100, sampling=None):
+        """
+        MiniGPT.generate without the KV cache: every step runs the last context_length tokens
+        through the compiled model (the cache changes shape at every token).
+        """
+        sampler = Sampler(sampling, device=context.device)
+        output = TokenBuffer(context.unsqueeze(0), max_new_tokens)
+        for _ in range(max_new_tokens):
+            logits = self.forward(output.tokens[:, -self.model.context_length :])
+            output.append(sampler(logits[:, -1, :]))
+        return output.tokens
+
+
+def _timed(fn, steps, device):
+    """Seconds per call of fn over steps calls."""
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / steps
+
+
+def benchmark(model, batch_size=8, steps=20, new_tokens=64, mode=None):
+    """
+    Eager vs compiled timings of a training step (forward + backward) and of generation.
+    The first compiled calls (compilation) are timed separately as warmup.
+    """
+    device = next(model.parameters()).device
+    compiled = CompiledMiniGPT(model, mode=mode)
+    x = torch.randint(model.config.vocab_size, (batch_size, model.context_length), device=device)
+    y = torch.roll(x, -1, dims=1)
+    prompt = x[0, :8]
+    results = {}
+
+    def train_step(forward):
+        def step():
+            model.zero_grad(set_to_none=True)
+            forward(x, targets=y).backward()
+
+        return step
+
+    model.train()
+    results["train eager (s/step)"] = _timed(train_step(model), steps, device)
+    results["train compile warmup (s)"] = _timed(train_step(compiled), 1, device)
+    results["train compiled (s/step)"] = _timed(train_step(compiled), steps, device)
+    model.zero_grad(set_to_none=True)
+
+    model.eval()
+    for name, generate in [
+        ("eager, kv cache", lambda: model.generate(prompt, new_tokens)),
+        ("eager, no cache", lambda: model.generate(prompt, new_tokens, use_kv_cache=False)),
+        ("compiled, no cache", lambda: compiled.generate(prompt, new_tokens)),
+    ]:
+        generate()  # warmup, compiles every bucket the sequence goes through
+        results[f"generate {name} (tokens/s)"] = new_tokens / _timed(generate, 3, device)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark eager vs torch.compile MiniGPT")
+    parser.add_argument("--checkpoint", type=Path, default=None, help="default: untrained MiniGPTConfig")
+    parser.add_argument("--mode", default=None, help="torch.compile mode")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    if args.checkpoint:
+        model = MiniGPT.from_checkpoint(args.checkpoint, map_location=args.device)
+    else:
+        model = MiniGPT(MiniGPTConfig()).to(args.device)
+    results = benchmark(model, args.batch_size, args.steps, args.new_tokens, args.mode)
+    for name, value in results.items():
+        print(f"{name:40s} {value:10.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 
 
 @dataclass
@@ -11,14 +11,30 @@ class BigramConfig:
     log_interval: int = 100
     save_path: Path = Path("models/bigram/")
     batch_size: int = 32
+    learning_rate: float = 1e-4
     scheduler: bool = False
     to_clip_grad: bool = False
     gradient_clip: float = 1.0
+    gradient_accumulation_steps: int = 1  # Micro batches per optimizer step
+    warmup_iters: int = 0  # Linear warmup steps of the scheduler
+    min_learning_rate: float = 0.0  # Learning rate at the end of the cosine decay
     vocab_size: int = 50257
     embed_dim: int = 32
     dropout: float = 0.1
     save_iterations: int = 10000
+    keep_checkpoints: int = 3  # Most recent checkpoints kept on disk, plus the best one
+    metrics_file: str = "metrics.jsonl"  # Step metrics written in save_path, .jsonl or .csv
+    sync_timing: bool = False  # Synchronize CUDA after every phase for exact phase timings
+    resume: bool = True  # Resume from the latest checkpoint in save_path if there is one
     max_iter: int = 500000
+    num_workers: int = 0  # DataLoader workers
+    ddp_backend: str = "gloo"  # Process group backend when launched with torchrun
+    prefetch_batches: int = 2  # Batches moved to the device ahead of the training step
+    data_seed: Optional[int] = None  # Seed of the training stream, None picks one at random
+    eval_interval: int = 1000  # Iterations between two evaluations
+    eval_stride: Optional[int] = None  # Stride of the evaluation windows, None is context_length // 2
+    eval_batches: Optional[int] = 1000  # Batches of every periodic evaluation, None is a full pass
+    final_eval: bool = True  # Full pass over the test split once training ends
 
 
 @dataclass
@@ -36,6 +52,9 @@ class MiniGPTConfig:
 
     context_length: int = 10  # Max number of tokens in a sequence
     num_heads: int = 4  # Number of heads in the multihead attention
+    fused_attention: bool = (
+        False  # Single QKV projection + batched attention matmul instead of a loop over heads
+    )
     weight_tie: bool = (
         True  # Whether to tie the weights of the embedding and the output layer
     )
@@ -47,8 +66,37 @@ class MiniGPTConfig:
     log_interval: int = 10
     save_path: Path = Path("models/minigpt/")
     save_iterations: int = 10000
+    keep_checkpoints: int = 3  # Most recent checkpoints kept on disk, plus the best one
+    metrics_file: str = "metrics.jsonl"  # Step metrics written in save_path, .jsonl or .csv
+    sync_timing: bool = False  # Synchronize CUDA after every phase for exact phase timings
+    resume: bool = True  # Resume from the latest checkpoint in save_path if there is one
     to_log: bool = True
     max_iter: int = 500000
     to_clip_grad: bool = False
     gradient_clip: float = 1.0
+    gradient_accumulation_steps: int = 1  # Micro batches per optimizer step
+    warmup_iters: int = 0  # Linear warmup steps of the scheduler
+    min_learning_rate: float = 0.0  # Learning rate at the end of the cosine decay
     scheduler: bool = False
+    checkpoint_every: int = 0  # Activation checkpointing of every k-th layer (0, 1, ...), 0 disables it
+    checkpoint_layers: Optional[Tuple[int, ...]] = None  # Explicit indices of checkpointed layers
+    loss_chunk_size: int = 256  # Tokens per chunk of the fused head + cross entropy in training
+    compile_mode: Optional[str] = None  # torch.compile mode of the training forward, None runs eagerly
+    precision: str = "fp32"  # fp32, bf16 or fp16 autocast (fp16 trains with a GradScaler)
+    packing: bool = False  # Train on whole documents packed back to back, attention reset at each EOT
+    num_workers: int = 0  # DataLoader workers
+    ddp_backend: str = "gloo"  # Process group backend when launched with torchrun
+    prefetch_batches: int = 2  # Batches moved to the device ahead of the training step
+    data_seed: Optional[int] = None  # Seed of the training stream, None picks one at random
+    eval_interval: int = 1000  # Iterations between two evaluations
+    eval_stride: Optional[int] = None  # Stride of the evaluation windows, None is context_length // 2
+    eval_batches: Optional[int] = 1000  # Batches of every periodic evaluation, None is a full pass
+    final_eval: bool = True  # Full pass over the test split once training ends
+
+
+@dataclass
+class SamplingConfig:
+    temperature: float = 1.0  # 0 means greedy decoding
+    top_k: Optional[int] = None  # Only sample among the k most likely tokens
+    top_p: Optional[float] = None  # Nucleus sampling: smallest set of tokens with this much mass
+    seed: Optional[int] = None  # Seed of the per request generator, None uses the global RNG
@@ -1,40 +1,393 @@
+import itertools
+import json
+import queue
+import threading
+from collections import deque
 from pathlib import Path
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Optional
 
 import numpy as np
 import torch
-from torch.utils.data import IterableDataset
+from torch.utils.data import IterableDataset, get_worker_info
 import tiktoken
 
 
+MANIFEST = "manifest.json"
+IGNORE_INDEX = -100  # target value skipped by the loss (nn.CrossEntropyLoss default)
+EOT_TOKEN = 50256  # separates the documents
+SCAN_BLOCK = 1 << 24  # tokens read at once when looking for the document boundaries
+
+
+def shard_files(data_folder: Path, mode: str) -> List[Tuple[Path, int]]:
+    """
+    (path, num_tokens) of the token files of a split: the shards listed in data_folder/manifest.json
+    (see prepare_data.py) or the single data_folder/{mode}.bin file.
+    """
+    manifest_path = data_folder / MANIFEST
+    if manifest_path.exists():
+        splits = json.loads(manifest_path.read_text())["splits"]
+        if mode in splits:
+            return [(data_folder / s["file"], s["num_tokens"]) for s in splits[mode]]
+    path = data_folder / f"{mode}.bin"
+    return [(path, path.stat().st_size // np.dtype(np.uint16).itemsize)]
+
+
+def document_ids(x: torch.Tensor, eot_token: int = EOT_TOKEN) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Position ids and segment ids of packed documents.
+
+    Every EOT token starts a new document (like a BOS token, as in unconditional generation),
+    the position ids restart from 0 there.
+
+    Args:
+    x : torch.Tensor
+        A (..., seq_len) tensor of tokens.
+
+    Output:
+    Tuple[torch.Tensor, torch.Tensor]
+        Position ids and segment ids, both the shape of x.
+    """
+    is_eot = x == eot_token
+    segment_ids = torch.cumsum(is_eot, dim=-1)
+    positions = torch.arange(x.size(-1)).expand_as(x)
+    segment_starts = torch.cummax(torch.where(is_eot, positions, 0), dim=-1).values
+    return positions - segment_starts, segment_ids
+
+
 # Iterable dataset for Tiny Stories
 class TinyStoriesDataset(IterableDataset):
-    def __init__(self, data_folder: Path, mode: str = "train", context_length: int = 2):
+    def __init__(
+        self,
+        data_folder: Path,
+        mode: str = "train",
+        context_length: int = 2,
+        batch_size: Optional[int] = None,
+        seed: Optional[int] = None,
+        packing: bool = False,
+        rank: int = 0,
+        world_size: int = 1,
+    ):
+        """
+        Random windows of context_length tokens (inputs) and the same windows shifted by one
+        (targets).
+
+        With batch_size set the dataset yields whole (batch_size, context_length) batches: all
+        the offsets are drawn at once and the windows gathered with a single fancy index, so use
+        it with DataLoader(dataset, batch_size=None). Otherwise it yields single windows.
+
+        The stream is deterministic: item (batch or window) number i is drawn from a generator
+        seeded with (seed, i), and with num_workers > 0 worker w produces items w, w + num_workers, ...
+        which the DataLoader returns in order. The stream is thus the same for any number of
+        workers and can be resumed with state_dict / load_state_dict (exactly in batch mode; with
+        DataLoader side batching and several workers each loader batch comes from one worker).
+        seed=None picks a random seed, which is still saved in state_dict.
+
+        For distributed training every rank builds the dataset with the same seed and its rank:
+        rank r of world_size gets items r, r + world_size, ... of the same global stream (split
+        further between its DataLoader workers), and state_dict counts the items of all the ranks.
+
+        The tokens may be split over several shards (data_folder/manifest.json written by
+        prepare_data.py), windows are numbered over all the shards and never cross a shard
+        boundary.
+
+        With packing the windows start at a document boundary (an EOT token) and the dataset
+        yields (x, y, position_ids, segment_ids): whole documents back to back, with position ids
+        restarting at every document. Pass position_ids and segment_ids to MiniGPT.forward, which
+        builds the mask with the module level document_attention_mask of model.py so the tokens
+        only attend within their document.
+        """
 
         if mode not in ["train", "test"]:
             raise ValueError("mode must be one of 'train', 'valid', or 'test'")
 
-        self.data_path = data_folder / f"{mode}.bin"
+        shards = shard_files(data_folder, mode)
+        self.shard_paths = [path for path, _ in shards]
+        self.shard_tokens = np.array([num_tokens for _, num_tokens in shards], dtype=np.int64)
+        # first global window index of every shard (and the total number of windows at the end)
+        self.window_starts = np.concatenate(
+            [[0], np.cumsum(np.maximum(self.shard_tokens - context_length, 0))]
+        )
         self.context_length = context_length
+        self.batch_size = batch_size
+        self.packing = packing
+        self.seed = seed if seed is not None else int(np.random.SeedSequence().entropy % 2**63)
+        self.start = 0  # index of the first item to produce
+        self.rank = rank
+        self.world_size = world_size
         # self.tokenizer = tiktoken.get_encoding("gpt2")
 
-        self.data = self.load_data()
+        self._shards = [None] * len(self.shard_paths)
         self.tokenizer = tiktoken.get_encoding("gpt2")
         self.vocab_size = self.tokenizer.n_vocab
 
-    def load_data(self) -> List[List[int]]:
+        if packing:
+            # computed once here rather than in every DataLoader worker
+            self.doc_shards, self.doc_offsets = self.document_windows()
+
+    def shard(self, i: int) -> np.memmap:
+        # mapped lazily (and never pickled) so every DataLoader worker maps the files itself
+        if self._shards[i] is None:
+            self._shards[i] = self.load_data(self.shard_paths[i])
+        return self._shards[i]
+
+    @property
+    def data(self) -> np.memmap:
+        """The tokens of a single file dataset."""
+        if len(self.shard_paths) != 1:
+            raise ValueError("data is only defined for a single shard, use shard(i)")
+        return self.shard(0)
+
+    @property
+    def num_windows(self) -> int:
+        if self.packing:
+            return len(self.doc_offsets)
+        return int(self.window_starts[-1])
+
+    def document_windows(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Shard and offset of every window starting at a document boundary."""
+        shards, offsets = [], []
+        for i, num_tokens in enumerate(self.shard_tokens):
+            data = self.shard(i)
+            starts = [np.zeros(1, dtype=np.int64)]
+            for block in range(0, num_tokens, SCAN_BLOCK):
+                starts.append(block + np.flatnonzero(data[block : block + SCAN_BLOCK] == EOT_TOKEN))
+            starts = np.unique(np.concatenate(starts))
+            starts = starts[starts + self.context_length < num_tokens]
+            shards.append(np.full_like(starts, i))
+            offsets.append(starts)
+        return np.concatenate(shards), np.concatenate(offsets)
+
+    def load_data(self, path: Path) -> np.memmap:
+        # zero copy: tokens stay uint16 on disk / in the page cache, only sampled windows are converted
+        return np.memmap(path, dtype=np.uint16, mode="r")
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_shards"] = [None] * len(self.shard_paths)
+        return state
+
+    def locate(self, idx: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Shard and offset in the shard of global window indices."""
+        if self.packing:
+            return self.doc_shards[idx], self.doc_offsets[idx]
+        shard = np.searchsorted(self.window_starts, idx, side="right") - 1
+        return shard, idx - self.window_starts[shard]
+
+    def window(self, idx: int) -> torch.Tensor:
+        """Tokens of window idx (context_length + 1 of them) as an int64 tensor."""
+        shard, offset = self.locate(idx)
+        tokens = self.shard(int(shard))[offset : offset + self.context_length + 1]
+        return torch.from_numpy(tokens.astype(np.int64))
+
+    def windows(self, idx: np.ndarray) -> torch.Tensor:
+        """(len(idx), context_length + 1) int64 windows idx, one gather per shard."""
+        shards, offsets = self.locate(idx)
+        positions = offsets[:, None] + np.arange(self.context_length + 1)
+        out = np.empty(positions.shape, dtype=np.int64)
+        for shard in np.unique(shards):
+            rows = shards == shard
+            out[rows] = self.shard(int(shard))[positions[rows]]
+        return torch.from_numpy(out)
+
+    def state_dict(self, consumed: int = 0) -> Dict[str, Any]:
+        """
+        Sampler state to checkpoint after consumed more items have been read from this dataset
+        (by each rank).
+        """
+        return {"seed": self.seed, "start": self.start + consumed * self.world_size}
 
-        data = torch.from_numpy(
-            np.memmap(self.data_path, dtype=np.uint16, mode="r").astype(np.int64)
+    def load_state_dict(self, state: Dict[str, Any]):
+        """Resume the stream, call it before creating the DataLoader iterator."""
+        self.seed = state["seed"]
+        self.start = state["start"]
+
+    def partition(self) -> Tuple[int, int]:
+        """First item and step between the items of this rank and DataLoader worker."""
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        return self.rank + self.world_size * worker_id, self.world_size * num_workers
+
+    def __iter__(self):
+        first, step = self.partition()
+        num_windows = self.num_windows
+        for index in itertools.count(self.start + first, step):
+            rng = np.random.default_rng([self.seed, index])
+            if self.batch_size is None:
+                window = self.window(int(rng.integers(num_windows)))
+            else:
+                window = self.windows(rng.integers(num_windows, size=self.batch_size))
+            x, y = window[..., :-1], window[..., 1:]
+            if self.packing:
+                yield (x, y) + document_ids(x)
+            else:
+                yield x, y
+
+    def __len__(self):
+        if self.batch_size is None:
+            return self.num_windows
+        return self.num_windows // self.batch_size
+
+
+class SequentialEvalDataset(TinyStoriesDataset):
+    def __init__(
+        self,
+        data_folder: Path,
+        mode: str = "test",
+        context_length: int = 2,
+        batch_size: int = 32,
+        stride: Optional[int] = None,
+        rank: int = 0,
+        world_size: int = 1,
+    ):
+        """
+        Every token of a split, once: (batch_size, context_length) batches of windows starting
+        every stride tokens (context_length // 2 by default) in every shard, the last window of a
+        shard aligned with its end.
+
+        Only the targets not scored by the previous window are kept, the others are set to
+        IGNORE_INDEX, so each token is predicted exactly once with at least
+        context_length - stride tokens of context (except at the start of a shard). Sum the
+        losses of the kept targets and divide by their count to get the exact token level loss.
+
+        With world_size > 1 rank r only gets batches r, r + world_size, ..., reduce the sums over
+        the ranks.
+        """
+        super().__init__(
+            data_folder, mode, context_length, batch_size, seed=0, rank=rank, world_size=world_size
         )
-        return data
+        self.stride = stride or max(context_length // 2, 1)
+        if not 0 < self.stride <= context_length:
+            raise ValueError("stride must be in [1, context_length]")
+
+        shards, starts, skips = [], [], []
+        for i, num_tokens in enumerate(self.shard_tokens):
+            last = num_tokens - 1 - context_length  # start of the window ending with the shard
+            if last < 0:
+                continue
+            start = np.arange(0, last + 1, self.stride)
+            if start[-1] != last:
+                start = np.append(start, last)
+            # targets already scored by the previous window of the shard
+            skip = np.zeros_like(start)
+            skip[1:] = context_length - np.diff(start)
+            shards.append(np.full_like(start, i))
+            starts.append(start)
+            skips.append(skip)
+        self.window_shards = np.concatenate(shards)
+        self.window_offsets = np.concatenate(starts)
+        self.window_skips = np.concatenate(skips)
+
+    @property
+    def num_targets(self) -> int:
+        """Number of scored targets in a full pass."""
+        return int((self.context_length - self.window_skips).sum())
 
     def __iter__(self):
-        while True:
-            idx = torch.randint(len(self.data) - self.context_length, (1,)).item()
-            yield self.data[idx : idx + self.context_length], self.data[
-                idx + 1 : idx + self.context_length + 1
-            ]
+        first, step = self.partition()
+        positions = np.arange(self.context_length + 1)
+        for batch in range(first, len(self), step):
+            rows = slice(batch * self.batch_size, (batch + 1) * self.batch_size)
+            shards, offsets = self.window_shards[rows], self.window_offsets[rows]
+            tokens = np.empty((len(offsets), self.context_length + 1), dtype=np.int64)
+            for shard in np.unique(shards):
+                selected = shards == shard
+                tokens[selected] = self.shard(int(shard))[offsets[selected, None] + positions]
+            tokens = torch.from_numpy(tokens)
+            x, y = tokens[:, :-1], tokens[:, 1:].clone()
+            skipped = torch.arange(self.context_length) < torch.from_numpy(
+                self.window_skips[rows]
+            )[:, None]
+            y[skipped] = IGNORE_INDEX
+            yield x, y
+
+    def __len__(self):
+        return -(-len(self.window_offsets) // self.batch_size)
+
+
+class DevicePrefetcher:
+    def __init__(self, loader, device, num_prefetch: int = 2):
+        """
+        Iterate over the batches (tuples of tensors) of loader already moved to device.
+
+        On CUDA the next num_prefetch batches are copied on a side stream with non blocking copies
+        from pinned memory, so the transfers overlap with the compute of the current step. On other
+        devices a background thread fetches and moves the next num_prefetch batches.
+        """
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_prefetch = max(num_prefetch, 1)
 
     def __len__(self):
-        return len(self.data) - self.context_length
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type == "cuda":
+            return self._cuda_iter()
+        return self._thread_iter()
+
+    def _cuda_iter(self):
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(self.loader)
+        in_flight = deque()
+
+        def enqueue():
+            batch = next(batches, None)
+            if batch is None:
+                return False
+            with torch.cuda.stream(stream):
+                batch = tuple(
+                    t.pin_memory().to(self.device, non_blocking=True)
+                    if not t.is_pinned()
+                    else t.to(self.device, non_blocking=True)
+                    for t in batch
+                )
+                copied = torch.cuda.Event()
+                copied.record(stream)
+            in_flight.append((batch, copied))
+            return True
+
+        while len(in_flight) < self.num_prefetch and enqueue():
+            pass
+        while in_flight:
+            batch, copied = in_flight.popleft()
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(copied)
+            for t in batch:
+                # the memory was allocated on the side stream, keep it alive for the compute stream
+                t.record_stream(current)
+            enqueue()
+            yield batch
+
+    def _thread_iter(self):
+        ready = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def worker():
+            try:
+                for batch in self.loader:
+                    batch = tuple(t.to(self.device) for t in batch)
+                    while not stop.is_set():
+                        try:
+                            ready.put(batch, timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
+                    if stop.is_set():
+                        return
+                ready.put(end)
+            except Exception as e:  # re-raised in the training loop
+                ready.put(e)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = ready.get()
+                if batch is end:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
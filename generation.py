@@ -0,0 +1,468 @@
+"""
+Batched, speculative and streaming generation for the models in model.py.
+
+Prompts of different lengths are left padded into one batch and decoded together; every
+sequence stops on its own (end of text token or its own token budget) and finished sequences are
+dropped from the batch so they do not cost any more compute.
+"""
+
+import asyncio
+import codecs
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterator, List, Optional, Sequence, Tuple, Union
+
+import tiktoken
+import torch
+
+from config import SamplingConfig
+from model import BigramLanguageModel
+from sampling import Sampler, TokenBuffer
+
+
+EOT_TOKEN = 50256  # <|endoftext|> of the tiktoken gpt2 encoding
+
+
+def _as_prompt(prompt):
+    prompt = torch.as_tensor(prompt, dtype=torch.long).flatten()
+    if prompt.numel() == 0:
+        raise ValueError("prompts must contain at least one token")
+    return prompt
+
+
+def _padding_mask(key_pad, num_new, num_cached):
+    """
+    Additive attention mask hiding padding keys.
+
+    Args:
+    key_pad : torch.Tensor
+        A bool tensor of shape (batch_size, num_keys), True for padding tokens.
+    num_new : int
+        Number of queries, i.e. the last num_new keys.
+    num_cached : int
+        Number of keys already in the kv cache, num_keys = num_cached + num_new.
+
+    Output:
+    torch.Tensor
+        A tensor of shape (batch_size, num_new, num_keys). A padding query still attends to itself
+        so that no row of the attention matrix is fully masked (which would give NaNs).
+    """
+    batch_size, num_keys = key_pad.shape
+    mask = torch.zeros(batch_size, num_new, num_keys, device=key_pad.device)
+    mask.masked_fill_(key_pad.unsqueeze(1), float("-inf"))
+    idx = torch.arange(num_new, device=key_pad.device)
+    mask[:, idx, num_cached + idx] = 0.0
+    return mask
+
+
+@torch.no_grad()
+def batched_decode(
+    model,
+    prompts: Sequence[Union[torch.Tensor, List[int]]],
+    max_new_tokens: Union[int, Sequence[int]] = 100,
+    eot_token: Optional[int] = EOT_TOKEN,
+    sampling: Union[None, SamplingConfig, Sequence[SamplingConfig]] = None,
+    rollover_keep: Optional[int] = None,
+):
+    """
+    Decode a batch of prompts step by step.
+
+    Args:
+    model : BigramLanguageModel or MiniGPT
+        The model to sample from.
+    prompts : Sequence[torch.Tensor or List[int]]
+        Token ids of every prompt, they may have different lengths.
+    max_new_tokens : int or Sequence[int]
+        Token budget, shared or per prompt.
+    eot_token : int, optional
+        A sequence stops right after sampling this token. None disables it.
+    sampling : SamplingConfig or Sequence[SamplingConfig], optional
+        Sampling parameters, shared or per prompt. A seeded config makes its prompt's output
+        reproducible independently of the rest of the batch.
+    rollover_keep : int, optional
+        Once the window is full, rebuild the KV cache from the last rollover_keep tokens only
+        (faster, but a shorter context right after every rollover). None re-encodes the last
+        context_length tokens at every step, exactly as without a cache.
+
+    Output:
+    Iterator[Tuple[torch.Tensor, torch.Tensor]]
+        For every step, the indices (into prompts) of the sequences still running and the token
+        sampled for each of them, both of shape (num_active,).
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    prompts = [_as_prompt(p) for p in prompts]
+    batch_size = len(prompts)
+    if isinstance(max_new_tokens, int):
+        max_new_tokens = [max_new_tokens] * batch_size
+    budget = torch.tensor(max_new_tokens, dtype=torch.long, device=device)
+    active = torch.arange(batch_size, device=device)
+    sampler = Sampler(sampling, batch_size=batch_size, device=device)
+
+    # drop the sequences that may not generate anything
+    keep = (budget > 0).nonzero().squeeze(1)
+    active, budget = active[keep], budget[keep]
+    sampler.index_select(keep)
+    if active.numel() == 0:
+        return
+
+    is_bigram = isinstance(model, BigramLanguageModel)
+    if not is_bigram:
+        # only the last context_length tokens can ever be seen by the model
+        prompts = [p[-model.context_length :] for p in prompts]
+
+    # left pad the prompts into (num_active, seq_len) with a padding mask
+    lengths = [prompts[i].numel() for i in active.tolist()]
+    seq_len = max(lengths)
+    prompt_tokens = torch.zeros(len(lengths), seq_len, dtype=torch.long, device=device)
+    prompt_pad = torch.ones(len(lengths), seq_len, dtype=torch.bool, device=device)
+    for row, (i, length) in enumerate(zip(active.tolist(), lengths)):
+        prompt_tokens[row, seq_len - length :] = prompts[i].to(device)
+        prompt_pad[row, seq_len - length :] = False
+    max_steps = int(budget.max())
+    tokens = TokenBuffer(prompt_tokens, max_steps)
+    pad = TokenBuffer(prompt_pad, max_steps)
+
+    kv_cache = None if is_bigram else model.init_kv_cache()
+    offset = 0  # first column of tokens held in kv_cache
+    generated = 0
+
+    while active.numel() > 0:
+        if is_bigram:
+            # the next token only depends on the last one
+            logits = model(tokens.tokens[:, -1:])  # (num_active, vocab_size)
+        else:
+            if tokens.length - offset > model.context_length:
+                keep_len = model.context_length
+                if rollover_keep is not None and kv_cache.length > 0:
+                    keep_len = min(max(1, rollover_keep), model.context_length)
+                kv_cache.reset()
+                offset = tokens.length - keep_len
+            num_cached = kv_cache.length
+            window_pad = pad.tokens[:, offset:]
+            new_tokens = tokens.tokens[:, offset + num_cached :]
+            num_new = new_tokens.size(1)
+            # positions restart at 0 on the first real token of every row
+            position_ids = ((~window_pad).long().cumsum(dim=1) - 1).clamp_(min=0)
+            position_ids = position_ids[:, num_cached:]
+            attn_mask = None
+            if window_pad.any():
+                attn_mask = _padding_mask(window_pad, num_new, num_cached)
+            logits = model(
+                new_tokens,
+                kv_cache=kv_cache,
+                attn_mask=attn_mask,
+                position_ids=position_ids,
+            )
+            logits = logits[:, -1, :]
+
+        next_token = sampler(logits)  # (num_active,)
+        generated += 1
+        yield active, next_token
+
+        tokens.append(next_token)
+        pad.append(False)
+
+        done = budget <= generated
+        if eot_token is not None:
+            done |= next_token == eot_token
+        if done.any():
+            keep = (~done).nonzero().squeeze(1)
+            active, budget = active[keep], budget[keep]
+            tokens.index_select(keep)
+            pad.index_select(keep)
+            sampler.index_select(keep)
+            if kv_cache is not None:
+                kv_cache.index_select(keep)
+
+
+def generate_batch(
+    model,
+    prompts: Sequence[Union[torch.Tensor, List[int]]],
+    max_new_tokens: Union[int, Sequence[int]] = 100,
+    eot_token: Optional[int] = EOT_TOKEN,
+    sampling: Union[None, SamplingConfig, Sequence[SamplingConfig]] = None,
+) -> List[torch.Tensor]:
+    """
+    Use the model to generate new tokens for several prompts at once.
+
+    Args:
+    model : BigramLanguageModel or MiniGPT
+        The model to sample from.
+    prompts : Sequence[torch.Tensor or List[int]]
+        Token ids of every prompt, they may have different lengths.
+    max_new_tokens : int or Sequence[int]
+        Token budget, shared or per prompt.
+    eot_token : int, optional
+        A sequence stops right after sampling this token. None disables it.
+    sampling : SamplingConfig or Sequence[SamplingConfig], optional
+        Sampling parameters, shared or per prompt. A seeded config makes its prompt's output
+        reproducible independently of the rest of the batch.
+
+    Output:
+    List[torch.Tensor]
+        For every prompt, a 1D tensor with the prompt followed by its generated tokens.
+    """
+    outputs = [[] for _ in prompts]
+    for rows, next_tokens in batched_decode(
+        model, prompts, max_new_tokens, eot_token, sampling
+    ):
+        for i, token in zip(rows.tolist(), next_tokens.tolist()):
+            outputs[i].append(token)
+    return [
+        torch.cat([_as_prompt(prompt), torch.tensor(out, dtype=torch.long)])
+        for prompt, out in zip(prompts, outputs)
+    ]
+
+
+@dataclass
+class SpeculativeStats:
+    proposed: int = 0  # draft tokens proposed
+    accepted: int = 0  # draft tokens accepted by the target model
+    target_forwards: int = 0  # target model forward passes (2 in the round crossing the window)
+    generated: int = 0  # tokens produced
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    @property
+    def tokens_per_forward(self) -> float:
+        return self.generated / self.target_forwards if self.target_forwards else 0.0
+
+
+def _next_token_logits(model, tokens):
+    """
+    Logits of the token following tokens (batch_size, seq_len) for a bigram or MiniGPT style model.
+    """
+    context_length = getattr(model, "context_length", None)
+    if isinstance(model, BigramLanguageModel):
+        tokens = tokens[:, -1:]
+    elif context_length is not None:
+        tokens = tokens[:, -context_length:]
+    logits = model(tokens)
+    if logits.dim() == 3:
+        logits = logits[:, -1, :]
+    return logits
+
+
+@torch.no_grad()
+def speculative_generate(
+    model,
+    draft_model,
+    context,
+    max_new_tokens=100,
+    num_draft_tokens=4,
+    sampling: Optional[SamplingConfig] = None,
+) -> Tuple[torch.Tensor, SpeculativeStats]:
+    """
+    Speculative decoding: the cheap draft_model proposes num_draft_tokens tokens and the MiniGPT
+    model scores all of them in a single (kv cached) forward pass.
+
+    Draft token x drawn from q is kept with probability min(1, p(x) / q(x)), p being the target
+    distribution; on the first rejection a token is drawn from max(0, p - q) (renormalized) and
+    the round stops, and when every draft is kept a bonus token is drawn from the target. The
+    output therefore follows exactly the distribution of MiniGPT.generate with the same sampling
+    config; both distributions are taken after temperature / top-k / top-p. Past context_length
+    tokens the target scores each position on its own last context_length tokens, like generate
+    once its window is full.
+
+    Args:
+    model : MiniGPT
+        The target model.
+    draft_model : nn.Module
+        Any model mapping (batch_size, seq_len) tokens to logits, e.g. a BigramLanguageModel or
+        a smaller MiniGPT.
+    context : torch.Tensor
+        A 1D tensor with the prompt tokens.
+    max_new_tokens : int
+        Number of tokens to generate.
+    num_draft_tokens : int
+        Tokens proposed per round.
+    sampling : SamplingConfig, optional
+        Sampling parameters shared by both models.
+
+    Output:
+    Tuple[torch.Tensor, SpeculativeStats]
+        A tensor of shape (1, prompt_len + max_new_tokens) like MiniGPT.generate, and the
+        acceptance statistics of the run.
+    """
+    model.eval()
+    draft_model.eval()
+    stats = SpeculativeStats()
+    sampler = Sampler(sampling, device=context.device)
+    output = TokenBuffer(context.unsqueeze(0), max_new_tokens + 1)
+    prompt_len = output.length
+    kv_cache = model.init_kv_cache()  # only used for the first context_length tokens
+    num_draft_tokens = max(1, min(num_draft_tokens, model.context_length - 1))
+
+    while stats.generated < max_new_tokens:
+        k = min(num_draft_tokens, max_new_tokens - stats.generated)
+        start = output.length
+
+        # draft k tokens
+        draft_probs = []
+        for _ in range(k):
+            q = sampler.probs(_next_token_logits(draft_model, output.tokens))  # (1, vocab_size)
+            output.append(sampler.sample_from(q))
+            draft_probs.append(q[0])
+
+        # verify them all with one pass of the target model, position t seeing the last
+        # context_length tokens before it exactly as in MiniGPT.generate
+        ctx = model.context_length
+        logits = []
+        if start <= ctx:
+            # positions up to ctx see a prefix of the first window, held in the kv cache
+            end = min(output.length, ctx)
+            window_logits = model(output.tokens[:, kv_cache.length : end], kv_cache=kv_cache)
+            logits.append(window_logits[0, -(end - start + 1) :, :])
+            stats.target_forwards += 1
+        if output.length > ctx:
+            # further positions each see their own sliding window, the cache cannot be reused
+            # (every position would shift) so the windows go through the model as one batch
+            first = max(start, ctx + 1)
+            windows = output.tokens[0, first - ctx : output.length].unfold(0, ctx, 1)
+            logits.append(model(windows)[:, -1, :])
+            stats.target_forwards += 1
+        p = sampler.probs(torch.cat(logits))  # (k + 1, vocab_size)
+        stats.proposed += k
+
+        drafts = output.tokens[0, start:].tolist()
+        num_accepted = 0
+        next_token = None
+        for j, token in enumerate(drafts):
+            q = draft_probs[j]
+            if sampler.uniform()[0] * q[token] < p[j, token]:
+                num_accepted += 1
+                continue
+            residual = (p[j] - q).clamp_(min=0)
+            if residual.sum() <= 0:
+                residual = p[j]
+            next_token = sampler.sample_from((residual / residual.sum()).unsqueeze(0))
+            break
+        if next_token is None:
+            next_token = sampler.sample_from(p[k].unsqueeze(0))
+
+        stats.accepted += num_accepted
+        stats.generated += num_accepted + 1
+        # keep the accepted drafts (in the cache too) and append the corrected / bonus token
+        output.truncate(start + num_accepted)
+        kv_cache.truncate(output.length)
+        output.append(next_token)
+
+    return output.tokens[:, : prompt_len + max_new_tokens], stats
+
+
+class IncrementalDetokenizer:
+    """
+    Decode gpt2 tokens one at a time.
+
+    A single token may hold only part of a multi byte UTF-8 character (and a character may be
+    split over several tokens), so the bytes of the tokens go through an incremental UTF-8
+    decoder which only returns complete characters.
+    """
+
+    def __init__(self, tokenizer=None):
+        self.tokenizer = tokenizer or tiktoken.get_encoding("gpt2")
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def push(self, token: int) -> str:
+        """Text completed by token, possibly empty."""
+        return self._decoder.decode(self.tokenizer.decode_single_token_bytes(token))
+
+    def flush(self) -> str:
+        """Whatever is left once the stream ends (replacement characters for incomplete bytes)."""
+        return self._decoder.decode(b"", final=True)
+
+
+def stream_generate(
+    model,
+    context,
+    max_new_tokens=100,
+    sampling: Optional[SamplingConfig] = None,
+    eot_token: Optional[int] = EOT_TOKEN,
+) -> Iterator[int]:
+    """
+    Yield every generated token as soon as it is sampled.
+
+    Args:
+    model : BigramLanguageModel or MiniGPT
+        The model to sample from.
+    context : torch.Tensor or List[int]
+        The prompt tokens.
+    max_new_tokens : int
+        Maximum number of tokens to generate.
+    sampling : SamplingConfig, optional
+        Sampling parameters.
+    eot_token : int, optional
+        Generation stops after this token (which is yielded). None disables it.
+
+    Output:
+    Iterator[int]
+        The generated tokens.
+    """
+    for _, next_tokens in batched_decode(model, [context], max_new_tokens, eot_token, sampling):
+        yield int(next_tokens[0])
+
+
+def stream_text(
+    model,
+    prompt: str,
+    max_new_tokens=100,
+    sampling: Optional[SamplingConfig] = None,
+    tokenizer=None,
+) -> Iterator[str]:
+    """
+    Yield the generated text piece by piece, stopping at the end of text token.
+
+    Args:
+    model : BigramLanguageModel or MiniGPT
+        The model to sample from.
+    prompt : str
+        The prompt.
+    max_new_tokens : int
+        Maximum number of tokens to generate.
+    sampling : SamplingConfig, optional
+        Sampling parameters.
+    tokenizer : tiktoken.Encoding, optional
+        Defaults to the gpt2 encoding.
+
+    Output:
+    Iterator[str]
+        Non empty pieces of text, their concatenation is the decoded generation.
+    """
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    context = detokenizer.tokenizer.encode(prompt)
+    for token in stream_generate(model, context, max_new_tokens, sampling, EOT_TOKEN):
+        if token == EOT_TOKEN:
+            break
+        text = detokenizer.push(token)
+        if text:
+            yield text
+    text = detokenizer.flush()
+    if text:
+        yield text
+
+
+async def _aiterate(iterator):
+    """Run every step of a blocking iterator in the default executor."""
+    loop = asyncio.get_running_loop()
+    done = object()
+    while True:
+        item = await loop.run_in_executor(None, next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+def astream_generate(*args, **kwargs) -> AsyncIterator[int]:
+    """
+    Async version of stream_generate, the model runs outside of the event loop.
+    """
+    return _aiterate(stream_generate(*args, **kwargs))
+
+
+def astream_text(*args, **kwargs) -> AsyncIterator[str]:
+    """
+    Async version of stream_text, the model runs outside of the event loop.
+    """
+    return _aiterate(stream_text(*args, **kwargs))
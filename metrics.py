@@ -0,0 +1,151 @@
+"""
+Lightweight training instrumentation: per phase step timings and a buffered metrics sink.
+
+Records are kept in memory (tensors included, never .item()'d on the training thread) and
+written every flush_every records by a background thread, as JSON lines or CSV rows depending on
+the file suffix, and optionally forwarded to wandb. The CSV header grows when a metric shows up
+for the first time (the file is then rewritten), no value is ever dropped.
+"""
+
+import csv
+import json
+import os
+import resource
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+
+
+class PhaseTimer:
+    def __init__(self, device="cpu", synchronize=False):
+        """
+        Wall clock time spent in named phases, accumulated until pop().
+
+        On CUDA kernels run asynchronously, so without synchronize the phases only measure the
+        host side (launches and waits); synchronize makes them exact at the cost of a sync per phase.
+        """
+        self.device = torch.device(device)
+        self.synchronize = synchronize and self.device.type == "cuda"
+        self.totals = defaultdict(float)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize(self.device)
+            self.totals[name] += time.perf_counter() - start
+
+    def pop(self):
+        """The accumulated seconds per phase, and reset them."""
+        totals, self.totals = dict(self.totals), defaultdict(float)
+        return totals
+
+
+def peak_memory_mb(device="cpu"):
+    """Peak allocated CUDA memory of device, or the peak resident memory of the process."""
+    device = torch.device(device)
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def _plain(value):
+    if isinstance(value, torch.Tensor):
+        return value.item()
+    return value
+
+
+class MetricsLogger:
+    def __init__(self, path=None, flush_every=50, use_wandb=False):
+        """
+        Args:
+        path : Path, optional
+            .jsonl or .csv file the records are appended to, None to skip the file.
+        flush_every : int
+            Records buffered before they are handed to the writer thread.
+        use_wandb : bool
+            Also send the records to wandb.log (wandb.init must have been called).
+        """
+        self.path = None if path is None else Path(path)
+        self.flush_every = flush_every
+        self.wandb = None
+        if use_wandb:
+            import wandb
+
+            self.wandb = wandb
+        self._buffer = []
+        self._columns = None  # CSV header, extended when new metrics show up
+        # a single writer thread keeps the records in order
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def log(self, metrics, step):
+        """Buffer a record, values may be scalar tensors (converted when written)."""
+        self._buffer.append({"step": step, "time": time.time(), **metrics})
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        records, self._buffer = self._buffer, []
+        if self._pending is not None:
+            self._pending.result()  # re-raise a failed write
+        self._pending = self._executor.submit(self._write, records)
+
+    def _write(self, records):
+        records = [{k: _plain(v) for k, v in record.items()} for record in records]
+        if self.wandb is not None:
+            for record in records:
+                self.wandb.log({k: v for k, v in record.items() if k != "step"}, step=record["step"])
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.suffix == ".csv":
+            self._write_csv(records)
+        else:
+            with open(self.path, "a") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+
+    def _write_csv(self, records):
+        if self._columns is None:
+            self._columns = []
+            if self.path.exists() and self.path.stat().st_size:
+                # appending (e.g. after a resume): start from the existing header
+                with open(self.path, newline="") as f:
+                    self._columns = next(csv.reader(f))
+        keys = dict.fromkeys(k for record in records for k in record)
+        new_columns = [k for k in keys if k not in self._columns]
+        if new_columns:
+            # a metric seen for the first time (e.g. the final evaluation) extends the header,
+            # the file is rewritten with empty cells for the earlier rows
+            self._columns = self._columns + new_columns
+            rows = []
+            if self.path.exists():
+                with open(self.path, newline="") as f:
+                    rows = list(csv.DictReader(f))
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp_path, "w", newline="") as f:
+                writer = csv.DictWriter(f, self._columns, restval="")
+                writer.writeheader()
+                writer.writerows(rows)
+            os.replace(tmp_path, self.path)
+        with open(self.path, "a", newline="") as f:
+            csv.DictWriter(f, self._columns, restval="").writerows(records)
+
+    def close(self):
+        self.flush()
+        if self._pending is not None:
+            self._pending.result()
+        self._executor.shutdown()
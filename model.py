@@ -1,12 +1,17 @@
 ## Building and training a bigram language model
+from contextlib import nullcontext
 from functools import partial
 import math
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from einops import einsum, reduce, rearrange
 
+from config import MiniGPTConfig
+from sampling import BigramAliasSampler, Sampler, TokenBuffer
+
 
 class BigramLanguageModel(nn.Module):
     """
@@ -82,7 +87,7 @@ class BigramLanguageModel(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def generate(self, context, max_new_tokens=100):
+    def generate(self, context, max_new_tokens=100, sampling=None):
         """
         Use the model to generate new tokens given a context.
         We will perform multinomial sampling which is very similar to greedy sampling
@@ -94,6 +99,8 @@ class BigramLanguageModel(nn.Module):
             A list of integers (tokens) representing the context.
         max_new_tokens : int
             The maximum number of new tokens to generate.
+        sampling : SamplingConfig, optional
+            Temperature, top-k, top-p and seed of the sampling, plain multinomial sampling by default.
 
         Output:
         List[int]
@@ -103,32 +110,285 @@ class BigramLanguageModel(nn.Module):
         ### ========= TODO : START ========= ###
 
         self.eval()
-        context = context.unsqueeze(0)
+        sampler = Sampler(sampling, device=context.device)
+        output = TokenBuffer(context.unsqueeze(0), max_new_tokens)  # (batch_size, seq_len + max_new_tokens)
         # Generate new tokens
         with torch.no_grad():
             for _ in range(max_new_tokens):
-                 # Get the logits from the model
-                logits = self.forward(context)  # (batch_size, seq_len, vocab_size)
-                
-                # Focus only on the last token's logits
-                logits = logits[:, -1, :]  # (batch_size, vocab_size)
-                
-                # Apply softmax to get probabilities
-                probs = F.softmax(logits, dim=-1)  # (batch_size, vocab_size)
+                # Get the logits from the model, the next token only depends on the last one
+                logits = self.forward(output.tokens[:, -1:])  # (batch_size, vocab_size)
                 
                 # Sample from the distribution
-                next_token = torch.multinomial(probs, num_samples=1)  # (batch_size, 1)
+                next_token = sampler(logits)  # (batch_size,)
                 
                 # Append the new token to the context
-                context = torch.cat([context, next_token], dim=1)  # (batch_size, seq_len + 1)
+                output.append(next_token)
         
         
         # Return the generated tokens as a list
         
-        return context
+        return output.tokens
 
         ### ========= TODO : END ========= ###
 
+    def alias_sampler(self, temperature=1.0, cache_size=256, seed=None):
+        """
+        O(1) per token sampler built on cached alias tables, see sampling.BigramAliasSampler.
+        """
+        self.eval()
+        return BigramAliasSampler(self, temperature, cache_size, seed)
+
+
+class KVBuffer:
+    """
+    Preallocated key/value buffer of one attention head, used for incremental decoding.
+
+    Keys and values are appended along the token dimension (dim -2) so the same buffer
+    works for a single head (batch_size, num_tokens, dim) or a group of heads
+    (batch_size, num_heads, num_tokens, dim). Inference only, writes are done in place.
+    """
+
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self.length = 0
+        self.key = None
+        self.value = None
+
+    def update(self, key, value):
+        """
+        Append the keys and values of the new tokens to the buffer.
+
+        Args:
+        key : torch.Tensor
+            A tensor of shape (..., num_new_tokens, key_dim).
+        value : torch.Tensor
+            A tensor of shape (..., num_new_tokens, value_dim).
+
+        Output:
+        Tuple[torch.Tensor, torch.Tensor]
+            Keys and values of all the cached tokens, (..., length, key_dim) and (..., length, value_dim).
+        """
+        num_new = key.size(-2)
+        if self.length + num_new > self.max_len:
+            raise RuntimeError(
+                f"KV cache overflow: {self.length} + {num_new} tokens exceed max_len={self.max_len}"
+            )
+        if self.key is None:
+            self.key = key.new_empty(key.shape[:-2] + (self.max_len, key.size(-1)))
+            self.value = value.new_empty(value.shape[:-2] + (self.max_len, value.size(-1)))
+
+        self.key[..., self.length : self.length + num_new, :] = key
+        self.value[..., self.length : self.length + num_new, :] = value
+        self.length += num_new
+        return self.key[..., : self.length, :], self.value[..., : self.length, :]
+
+    def index_select(self, index):
+        """
+        Keep only the batch rows in index (a 1D LongTensor), e.g. to drop finished sequences.
+        """
+        if self.key is not None:
+            self.key = self.key.index_select(0, index)
+            self.value = self.value.index_select(0, index)
+
+
+class KVCache:
+    """
+    Key/value cache of a whole MiniGPT model.
+
+    self.layers holds, for every transformer layer, whatever the attention layer returned from
+    init_kv_cache (a list of KVBuffer, one per head).
+    """
+
+    def __init__(self, layers):
+        self.layers = layers
+
+    def buffers(self):
+        for layer in self.layers:
+            if isinstance(layer, KVBuffer):
+                yield layer
+            else:
+                yield from layer
+
+    @property
+    def length(self):
+        """Number of tokens currently held in the cache."""
+        return next(self.buffers()).length
+
+    @property
+    def max_len(self):
+        return next(self.buffers()).max_len
+
+    def reset(self):
+        for buffer in self.buffers():
+            buffer.length = 0
+
+    def truncate(self, length):
+        """Drop every cached token after the first length ones (e.g. rejected draft tokens)."""
+        for buffer in self.buffers():
+            buffer.length = min(buffer.length, length)
+
+    def index_select(self, index):
+        for buffer in self.buffers():
+            buffer.index_select(index)
+
+
+IGNORE_INDEX = -100  # targets skipped by the loss, as in nn.CrossEntropyLoss
+
+
+def _chunk_logits(hidden, weight, bias):
+    logits = hidden.float() @ weight.float().t()
+    if bias is not None:
+        logits += bias.float()
+    return logits
+
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    Cross entropy of a linear head, hidden @ weight.T + bias, computed chunk_size tokens at a time
+    so that only (chunk_size, vocab_size) logits exist at once.
+
+    The loss is a sum over tokens (scaled by 1 / normalizer), so its gradients are computed in the
+    same pass as the loss and only multiplied by the output gradient in backward: neither pass
+    ever holds the full logits.
+    """
+
+    @staticmethod
+    def forward(ctx, hidden, weight, bias, targets, chunk_size, normalizer):
+        # hidden: (num_tokens, embed_dim), targets: (num_tokens,)
+        with torch.autocast(hidden.device.type, enabled=False):
+            loss = torch.zeros((), dtype=torch.float32, device=hidden.device)
+            grad_hidden = torch.zeros_like(hidden, dtype=torch.float32)
+            grad_weight = torch.zeros_like(weight, dtype=torch.float32)
+            grad_bias = None if bias is None else torch.zeros_like(bias, dtype=torch.float32)
+            for start in range(0, hidden.size(0), chunk_size):
+                h = hidden[start : start + chunk_size]
+                t = targets[start : start + chunk_size]
+                valid = t != IGNORE_INDEX
+                t = t.masked_fill(~valid, 0)
+                logits = _chunk_logits(h, weight, bias)
+                logsumexp = torch.logsumexp(logits, dim=-1)
+                target_logits = logits.gather(1, t.unsqueeze(1)).squeeze(1)
+                loss += ((logsumexp - target_logits) * valid).sum()
+
+                # d loss / d logits = softmax - one_hot, reusing the logits buffer
+                grad_logits = logits.sub_(logsumexp.unsqueeze(1)).exp_()
+                grad_logits[torch.arange(len(t), device=t.device), t] -= 1
+                grad_logits *= valid.unsqueeze(1) / normalizer
+                grad_hidden[start : start + chunk_size] = grad_logits @ weight.float()
+                grad_weight.addmm_(grad_logits.t(), h.float())
+                if grad_bias is not None:
+                    grad_bias += grad_logits.sum(0)
+        ctx.save_for_backward(grad_hidden, grad_weight, grad_bias)
+        ctx.dtypes = (hidden.dtype, weight.dtype, None if bias is None else bias.dtype)
+        return loss / normalizer
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grads = [
+            None if g is None else (g * grad_output).to(dtype)
+            for g, dtype in zip(ctx.saved_tensors, ctx.dtypes)
+        ]
+        return grads[0], grads[1], grads[2], None, None, None
+
+
+def chunked_cross_entropy(hidden, weight, bias, targets, chunk_size=256, reduction="mean"):
+    """
+    Cross entropy of the logits hidden @ weight.T + bias without materializing them.
+
+    Args:
+    hidden : torch.Tensor
+        A tensor of shape (..., embed_dim), e.g. the output of MiniGPT.hidden_states.
+    weight, bias : torch.Tensor
+        The (vocab_size, embed_dim) weight and (vocab_size,) bias (or None) of the head. With
+        weight tying the gradient of weight adds up with the one of the embedding.
+    targets : torch.Tensor
+        A LongTensor of the shape of hidden without its last dimension, IGNORE_INDEX to skip.
+    reduction : str
+        "mean" over the non ignored targets (like nn.CrossEntropyLoss) or "sum".
+
+    Output:
+    torch.Tensor
+        The fp32 scalar loss.
+    """
+    hidden = hidden.reshape(-1, hidden.size(-1))
+    targets = targets.reshape(-1)
+    if reduction == "mean":
+        # a tensor: no host sync (and no graph break when compiled)
+        normalizer = (targets != IGNORE_INDEX).sum().clamp(min=1)
+    elif reduction == "sum":
+        normalizer = 1
+    else:
+        raise ValueError(f"reduction must be 'mean' or 'sum', got {reduction!r}")
+
+    needs_grad = torch.is_grad_enabled() and any(
+        t is not None and t.requires_grad for t in (hidden, weight, bias)
+    )
+    if needs_grad:
+        return ChunkedCrossEntropy.apply(hidden, weight, bias, targets, chunk_size, normalizer)
+    # loss only (evaluation)
+    loss = torch.zeros((), dtype=torch.float32, device=hidden.device)
+    with torch.autocast(hidden.device.type, enabled=False):
+        for start in range(0, hidden.size(0), chunk_size):
+            logits = _chunk_logits(hidden[start : start + chunk_size], weight, bias)
+            loss += F.cross_entropy(
+                logits, targets[start : start + chunk_size], ignore_index=IGNORE_INDEX, reduction="sum"
+            )
+    return loss / normalizer
+
+
+PRECISION_DTYPES = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def precision_context(precision, device):
+    """
+    Autocast context of a precision ("fp32", "bf16" or "fp16") on device (a torch.device or a
+    device type string). Matmuls run in the reduced precision, fp32 is a no-op.
+    """
+    if precision not in PRECISION_DTYPES:
+        raise ValueError(f"precision must be one of {list(PRECISION_DTYPES)}, got {precision!r}")
+    dtype = PRECISION_DTYPES[precision]
+    if dtype is None:
+        return nullcontext()
+    device_type = device if isinstance(device, str) else device.type
+    return torch.autocast(device_type, dtype=dtype)
+
+
+def make_causal_mask(max_len):
+    """(max_len, max_len) additive mask, -inf above the diagonal."""
+    return torch.triu(torch.full((max_len, max_len), float('-inf')), diagonal=1)
+
+
+def causal_mask_slice(causal_mask, past, num_tokens):
+    """
+    Causal mask of num_tokens queries at positions past onwards over past + num_tokens keys: a
+    slice of the precomputed causal_mask buffer (no allocation, nothing to trace), built on the
+    fly only beyond its size.
+    """
+    if past + num_tokens <= causal_mask.size(0):
+        return causal_mask[past : past + num_tokens, : past + num_tokens]
+    return torch.triu(
+        torch.full((num_tokens, past + num_tokens), float('-inf'), device=causal_mask.device),
+        diagonal=past + 1,
+    )
+
+
+def document_attention_mask(segment_ids):
+    """
+    Additive attention mask of packed documents: a token only attends to the tokens of its own
+    document. Together with the causal mask this makes a block diagonal causal mask.
+
+    Args:
+    segment_ids : torch.Tensor
+        A tensor of shape (batch_size, seq_len), the document index of every token.
+
+    Output:
+    torch.Tensor
+        A float tensor of shape (batch_size, seq_len, seq_len), 0 within a document and -inf across.
+    """
+    same_document = segment_ids.unsqueeze(-1) == segment_ids.unsqueeze(-2)
+    mask = torch.zeros(same_document.shape, device=segment_ids.device)
+    return mask.masked_fill_(~same_document, float('-inf'))
+
 
 class SingleHeadAttention(nn.Module):
     """
@@ -194,13 +454,19 @@ class SingleHeadAttention(nn.Module):
             "causal_mask", causal_mask
         )  # Registering as buffer to avoid backpropagation
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None, attn_mask=None):
         """
         Forward pass of the Single Head Attention Layer.
 
         Args:
         x : torch.Tensor
             A tensor of shape (batch_size, num_tokens, token_dim) containing the input tokens.
+        kv_cache : KVBuffer, optional
+            Keys and values of the previous tokens. When given, x only holds the new tokens,
+            their keys and values are appended to the cache and they attend to every cached token.
+        attn_mask : torch.Tensor, optional
+            Additive mask of shape (batch_size, num_tokens, num_keys) added on top of the causal
+            mask, -inf where a query must not attend to a key (e.g. padding).
 
         Output:
         torch.Tensor
@@ -212,13 +478,19 @@ class SingleHeadAttention(nn.Module):
         K = self.key(x)
         V = self.value(x)
         num_tokens = x.size(1)
+        past = 0
+        if kv_cache is not None:
+            past = kv_cache.length
+            K, V = kv_cache.update(K, V)
         prod = torch.matmul(Q,torch.transpose(K,1,2))
-        device = x.get_device()
-        causal_mask = torch.zeros((num_tokens, num_tokens)) + torch.triu(torch.full((num_tokens, num_tokens), float('-inf')), diagonal=1)
-        prod += causal_mask.to(device)
-        #prod += self.causal_mask[:num_tokens,:num_tokens]
+        if num_tokens > 1:
+            # query i sits at position past + i and may only look at keys up to that position
+            prod += causal_mask_slice(self.causal_mask, past, num_tokens)
+        if attn_mask is not None:
+            prod = prod + attn_mask
         prod = prod/math.sqrt(self.output_key_query_dim)
-        prod = F.softmax(prod,dim=2)
+        # softmax in fp32 even under autocast, the probabilities go back to the dtype of V
+        prod = F.softmax(prod.float(),dim=2).to(V.dtype)
         result = torch.matmul(prod,V)
         return result
 
@@ -232,7 +504,7 @@ class MultiHeadAttention(nn.Module):
     As in Attention is All You Need (https://arxiv.org/pdf/1706.03762)
     """
 
-    def __init__(self, input_dim, num_heads, dropout=0.1) -> None:
+    def __init__(self, input_dim, num_heads, dropout=0.1, fused=False) -> None:
         """
         Initialize the Multi Head Attention Layer.
 
@@ -241,12 +513,19 @@ class MultiHeadAttention(nn.Module):
         2. A linear layer for output. (self.out) **set bias to True**
         3. A dropout layer. (self.dropout) Apply dropout to the output of the out layer.
 
+        With fused=True the heads are replaced by a single projection (self.qkv) producing the
+        queries, keys and values of every head at once, and attention runs as one batched matmul
+        over (batch_size, num_heads, num_tokens, head_dim). The state dict still uses the
+        head_{i}.query/key/value layout so checkpoints load into either mode.
+
         NOTE : PLEASE KEEP OF EACH LAYER AS PROVIDED BELOW TO FACILITATE TESTING.
         """
         super().__init__()
 
         self.input_dim = input_dim
         self.num_heads = num_heads
+        self.head_dim = input_dim // num_heads
+        self.fused = fused
 
         # ========= TODO : START ========= #
 
@@ -254,23 +533,101 @@ class MultiHeadAttention(nn.Module):
         # self.out = ...
         # self.dropout = ...
         
-        for i in range(num_heads):
-            setattr(self,f'head_{i}',SingleHeadAttention(input_dim = input_dim,
-            output_key_query_dim=input_dim//num_heads,
-            output_value_dim = input_dim//num_heads
-            ))
+        if fused:
+            # rows are [query of head 0..n-1, key of head 0..n-1, value of head 0..n-1]
+            self.qkv = nn.Linear(input_dim, 3 * num_heads * self.head_dim, bias=False)
+            # not saved, the state dict hook writes the per head masks
+            self.register_buffer("causal_mask", make_causal_mask(512), persistent=False)
+            self._register_state_dict_hook(self._split_qkv_state_dict)
+            self._register_load_state_dict_pre_hook(self._merge_head_state_dict)
+        else:
+            for i in range(num_heads):
+                setattr(self,f'head_{i}',SingleHeadAttention(input_dim = input_dim,
+                output_key_query_dim=input_dim//num_heads,
+                output_value_dim = input_dim//num_heads
+                ))
         self.out = nn.Linear(input_dim, input_dim,bias=True)
         self.dropout = nn.Dropout(dropout)
 
         # ========= TODO : END ========= #
 
-    def forward(self, x):
+    def _split_qkv_state_dict(self, module, state_dict, prefix, local_metadata):
+        """
+        State dict hook of the fused mode: rewrite qkv.* into the per head layout.
+
+        Every tensor of the qkv module (weight, and the quantization scales if any) is split along
+        its first dimension, and the causal mask buffers of the heads are added back.
+        """
+        names = [k[len(prefix) + 4 :] for k in state_dict if k.startswith(prefix + "qkv.")]
+        for name in names:
+            fused = state_dict.pop(prefix + "qkv." + name)
+            rows = fused.size(0) // 3
+            for j, proj in enumerate(("query", "key", "value")):
+                part = fused[j * rows : (j + 1) * rows]
+                for i, head in enumerate(part.chunk(self.num_heads, dim=0)):
+                    state_dict[f"{prefix}head_{i}.{proj}.{name}"] = head
+        for i in range(self.num_heads):
+            state_dict[f"{prefix}head_{i}.causal_mask"] = self.causal_mask
+        return state_dict
+
+    def _merge_head_state_dict(
+        self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs
+    ):
+        """
+        Load state dict pre hook of the fused mode: concatenate head_{i}.query/key/value.* into qkv.*
+        """
+        head_prefix = prefix + "head_0.query."
+        names = [k[len(head_prefix) :] for k in state_dict if k.startswith(head_prefix)]
+        for name in names:
+            parts = [
+                state_dict.pop(f"{prefix}head_{i}.{proj}.{name}")
+                for proj in ("query", "key", "value")
+                for i in range(self.num_heads)
+            ]
+            state_dict[prefix + "qkv." + name] = torch.cat(parts, dim=0)
+        for i in range(self.num_heads):
+            state_dict.pop(f"{prefix}head_{i}.causal_mask", None)
+
+    def init_kv_cache(self, max_len):
+        """
+        Create the key/value cache of this layer: one KVBuffer per head, or a single one holding
+        every head in fused mode.
+        """
+        if self.fused:
+            return KVBuffer(max_len)
+        return [KVBuffer(max_len) for _ in range(self.num_heads)]
+
+    def _fused_attention(self, x, kv_cache=None, attn_mask=None):
+        num_tokens = x.size(1)
+        qkv = self.qkv(x)
+        Q, K, V = rearrange(
+            qkv, "b t (three h d) -> three b h t d", three=3, h=self.num_heads
+        )  # each (batch_size, num_heads, num_tokens, head_dim)
+        past = 0
+        if kv_cache is not None:
+            past = kv_cache.length
+            K, V = kv_cache.update(K, V)
+        prod = torch.matmul(Q, K.transpose(-2, -1))
+        if num_tokens > 1:
+            prod += causal_mask_slice(self.causal_mask, past, num_tokens)
+        if attn_mask is not None:
+            prod = prod + attn_mask.unsqueeze(1)  # broadcast over the heads
+        prod = prod / math.sqrt(self.head_dim)
+        prod = F.softmax(prod.float(), dim=-1).to(V.dtype)
+        y = torch.matmul(prod, V)
+        return rearrange(y, "b h t d -> b t (h d)")
+
+    def forward(self, x, kv_cache=None, attn_mask=None):
         """
         Forward pass of the Multi Head Attention Layer.
 
         Args:
         x : torch.Tensor
             A tensor of shape (batch_size, num_tokens, token_dim) containing the input tokens.
+        kv_cache : List[KVBuffer], optional
+            Cache of this layer as returned by init_kv_cache.
+        attn_mask : torch.Tensor, optional
+            Additive mask of shape (batch_size, num_tokens, num_keys), see SingleHeadAttention.
 
         Output:
         torch.Tensor
@@ -278,14 +635,17 @@ class MultiHeadAttention(nn.Module):
         """
 
         # ========= TODO : START ========= #
-        head_output = []
-        for i in range(self.num_heads):
-            head = getattr(self,f'head_{i}')
-            y = head(x)
+        if self.fused:
+            y = self._fused_attention(x, kv_cache, attn_mask)
+        else:
+            head_output = []
+            for i in range(self.num_heads):
+                head = getattr(self,f'head_{i}')
+                y = head(x, None if kv_cache is None else kv_cache[i], attn_mask)
+                
+                head_output.append(y)
             
-            head_output.append(y)
-        
-        y = torch.cat(head_output,dim=-1)
+            y = torch.cat(head_output,dim=-1)
         y = self.out(y)
         y = self.dropout(y)
 
@@ -344,13 +704,7 @@ class FeedForwardLayer(nn.Module):
 
         ### ========= TODO : START ========= ###
 
-        model = nn.Sequential(
-            self.fc1,
-            self.activation,
-            self.fc2,
-            self.dropout
-            )
-        x = model(x)
+        x = self.dropout(self.fc2(self.activation(self.fc1(x))))
 
         ### ========= TODO : END ========= ###
         return x 
@@ -387,15 +741,17 @@ class LayerNorm(nn.Module):
         """
 
         # ========= TODO : START ========= #
-        mean = input.mean(dim=-1,keepdim = True)
-        var = input.var(dim=-1,keepdim=True,unbiased=False)
+        # statistics in fp32 for reduced precision inputs, the output keeps the input dtype
+        x = input.float()
+        mean = x.mean(dim=-1,keepdim = True)
+        var = x.var(dim=-1,keepdim=True,unbiased=False)
         
-        normalized_input = (input - mean)/torch.sqrt(var + self.eps) 
+        normalized_input = (x - mean)/torch.sqrt(var + self.eps) 
         
         if self.elementwise_affine:
             normalized_input = self.beta + normalized_input * self.gamma
         
-        return normalized_input         
+        return normalized_input.to(input.dtype)
 
         # ========= TODO : END ========= #
 
@@ -405,7 +761,7 @@ class TransformerLayer(nn.Module):
     Class definition for a single transformer layer.
     """
 
-    def __init__(self, input_dim, num_heads, feedforward_dim=None):
+    def __init__(self, input_dim, num_heads, feedforward_dim=None, fused_attention=False):
         super().__init__()
         """
         Initialize the Transformer Layer.
@@ -427,19 +783,23 @@ class TransformerLayer(nn.Module):
         # self.norm2 = ...
         # self.feedforward = ...
         self.norm1 = LayerNorm(normalized_shape=input_dim)
-        self.attention = MultiHeadAttention(input_dim = input_dim , num_heads = num_heads)
+        self.attention = MultiHeadAttention(input_dim = input_dim , num_heads = num_heads, fused = fused_attention)
         self.norm2 = LayerNorm(normalized_shape=input_dim)
         self.feedforward = FeedForwardLayer(input_dim = input_dim,feedforward_dim=None)
 
         # ========= TODO : END ========= #
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None, attn_mask=None):
         """
         Forward pass of the Transformer Layer.
 
         Args:
         x : torch.Tensor
             A tensor of shape (batch_size, num_tokens, token_dim) containing the input tokens.
+        kv_cache : optional
+            Key/value cache of the attention layer (see MultiHeadAttention.init_kv_cache).
+        attn_mask : torch.Tensor, optional
+            Additive attention mask of shape (batch_size, num_tokens, num_keys).
 
         Output:
         torch.Tensor
@@ -449,7 +809,7 @@ class TransformerLayer(nn.Module):
         # ========= TODO : START ========= #
 
         x1 = self.norm1(x)
-        x1 = self.attention(x1)
+        x1 = self.attention(x1, kv_cache, attn_mask)
         x = x + x1 
         x1 = self.norm2(x)
         x1 = self.feedforward(x1)
@@ -480,6 +840,7 @@ class MiniGPT(nn.Module):
 
         NOTE: You do not need to modify anything here.
         """
+        self.config = config
         self.context_length = config.context_length
         self.vocab_embedding = nn.Embedding(config.vocab_size, config.embed_dim)
         self.positional_embedding = nn.Embedding(
@@ -490,12 +851,20 @@ class MiniGPT(nn.Module):
         self.transformer_layers = nn.ModuleList(
             [
                 TransformerLayer(
-                    config.embed_dim, config.num_heads, config.feedforward_size
+                    config.embed_dim,
+                    config.num_heads,
+                    config.feedforward_size,
+                    fused_attention=config.fused_attention,
                 )
                 for _ in range(config.num_layers)
             ]
         )
 
+        # layers whose activations are recomputed in the backward pass instead of stored
+        self.checkpointed_layers = set(config.checkpoint_layers or ())
+        if config.checkpoint_every:
+            self.checkpointed_layers.update(range(0, config.num_layers, config.checkpoint_every))
+
         # prehead layer norm
         self.prehead_norm = LayerNorm(config.embed_dim)
 
@@ -512,7 +881,27 @@ class MiniGPT(nn.Module):
 
         self.apply(self._init_weights)
 
-    def forward(self, x):
+    def init_kv_cache(self):
+        """
+        Create an empty key/value cache holding up to context_length tokens for incremental decoding.
+        """
+        return KVCache(
+            [
+                layer.attention.init_kv_cache(self.context_length)
+                for layer in self.transformer_layers
+            ]
+        )
+
+    def forward(
+        self,
+        x,
+        kv_cache=None,
+        attn_mask=None,
+        position_ids=None,
+        segment_ids=None,
+        targets=None,
+        reduction="mean",
+    ):
         """
         Forward pass of the MiniGPT model.
 
@@ -521,22 +910,70 @@ class MiniGPT(nn.Module):
         Args:
         x : torch.Tensor
             A tensor of shape (batch_size, seq_len) containing the input tokens.
+        kv_cache : KVCache, optional
+            Cache created with init_kv_cache. When given, x holds only the tokens that follow the
+            cached ones: they are placed at positions kv_cache.length onwards and appended to the cache.
+        attn_mask : torch.Tensor, optional
+            Additive mask of shape (batch_size, seq_len, num_keys) applied in every attention layer
+            on top of the causal mask, num_keys being kv_cache.length + seq_len.
+        position_ids : torch.Tensor, optional
+            A tensor of shape (batch_size, seq_len) with the position of every token, for inputs
+            that do not start at position 0 (e.g. left padded prompts).
+        segment_ids : torch.Tensor, optional
+            A tensor of shape (batch_size, seq_len) with the document of every token, for packed
+            sequences: attention is restricted to each document (see document_attention_mask).
+            Pass the matching per document position_ids along.
+        targets : torch.Tensor, optional
+            A LongTensor of shape (batch_size, seq_len). When given the cross entropy loss (with
+            reduction "mean" or "sum") is returned instead of the logits, computed
+            config.loss_chunk_size tokens at a time (see chunked_cross_entropy) so the
+            (batch_size, seq_len, vocab_size) logits are never materialized.
 
         Output:
         torch.Tensor
-            A tensor of shape (batch_size, seq_len, vocab_size) containing the logits.
+            A tensor of shape (batch_size, seq_len, vocab_size) containing the logits, in the
+            reduced precision dtype when config.precision is not "fp32". The scalar loss with targets.
+        """
+        hidden = self.hidden_states(x, kv_cache, attn_mask, position_ids, segment_ids)
+        if targets is not None:
+            return chunked_cross_entropy(
+                hidden,
+                self.head.weight,
+                self.head.bias,
+                targets,
+                self.config.loss_chunk_size,
+                reduction,
+            )
+        with precision_context(self.config.precision, x.device):
+            return self.head(hidden)  # (batch_size, seq_len, vocab_size)
+
+    def hidden_states(self, x, kv_cache=None, attn_mask=None, position_ids=None, segment_ids=None):
+        """
+        The output of the last transformer layer after prehead_norm, (batch_size, seq_len, embed_dim):
+        forward without the language modelling head. Same arguments as forward.
         """
 
         ### ========= TODO : START ========= ###
+        if segment_ids is not None:
+            document_mask = document_attention_mask(segment_ids)
+            attn_mask = document_mask if attn_mask is None else attn_mask + document_mask
         seq_len = x.size(1)
+        start = 0 if kv_cache is None else kv_cache.length
         x = self.vocab_embedding(x) # (batch_size, seq_len, embed_dim)
-        pos_embed = self.positional_embedding(self.pos[:seq_len]) # (seq_len, embed_dim)
-        pos_embed = self.embed_dropout(pos_embed) # (seq_len, embed_dim)
+        if position_ids is None:
+            position_ids = self.pos[start:start + seq_len]
+        pos_embed = self.positional_embedding(position_ids) # (seq_len, embed_dim) or (batch_size, seq_len, embed_dim)
+        pos_embed = self.embed_dropout(pos_embed)
         x += pos_embed # (batch_size, seq_len, embed_dim) 
-        for layers in self.transformer_layers:
-            x = layers(x) # (batch_size, seq_len, embed_dim) 
-        x = self.prehead_norm(x) # (batch_size, seq_len, embed_dim) 
-        x = self.head(x)  # (batch_size, seq_len, vocab_size) 
+        # config.precision: autocast the matmuls, the residual stream stays in fp32
+        with precision_context(self.config.precision, x.device):
+            for i, layers in enumerate(self.transformer_layers):
+                if i in self.checkpointed_layers and kv_cache is None and self.training and torch.is_grad_enabled():
+                    # only the layer input is kept, the attention maps etc. are recomputed on backward
+                    x = checkpoint(layers, x, None, attn_mask, use_reentrant=False)
+                    continue
+                x = layers(x, None if kv_cache is None else kv_cache.layers[i], attn_mask) # (batch_size, seq_len, embed_dim) 
+            x = self.prehead_norm(x) # (batch_size, seq_len, embed_dim) 
 
         ### ========= TODO : END ========= ###
         return x 
@@ -561,34 +998,88 @@ class MiniGPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def generate(self, context, max_new_tokens=100):
+    def generate(self, context, max_new_tokens=100, use_kv_cache=True, sampling=None, rollover_keep=None):
         """
         Use the model to generate new tokens given a context.
 
         Please copy the generate function from the BigramLanguageModel class you had implemented earlier.
+
+        sampling is an optional SamplingConfig (temperature, top-k, top-p, seed).
+
+        With use_kv_cache the keys/values of the previous tokens are cached so every step only runs
+        the new token through the model. Sliding the window by one token would invalidate every cached
+        position, so once the window is full the last context_length tokens are re-encoded from
+        position 0 at every step, which samples exactly like use_kv_cache=False. rollover_keep trades
+        that for speed: the cache is rebuilt from the last rollover_keep tokens only and then grows
+        again, so the model sees a shorter context right after every rollover.
         """
-        context = context.unsqueeze(0)
+        sampler = Sampler(sampling, device=context.device)
+        output = TokenBuffer(context.unsqueeze(0), max_new_tokens)
+        kv_cache = self.init_kv_cache() if use_kv_cache else None
+        offset = 0  # index in context of the first token held in kv_cache
         # Generate new tokens
         with torch.no_grad():
             for _ in range(max_new_tokens):
+                context = output.tokens
                 # Get the logits from the model
-                logits = self.forward(context[:,-self.context_length:])  # (batch_size, seq_len, vocab_size)
+                if kv_cache is None:
+                    logits = self.forward(context[:,-self.context_length:])  # (batch_size, seq_len, vocab_size)
+                else:
+                    if context.size(1) - offset > self.context_length:
+                        keep = self.context_length
+                        if rollover_keep is not None and kv_cache.length > 0:
+                            keep = min(max(1, rollover_keep), self.context_length)
+                        kv_cache.reset()
+                        offset = context.size(1) - keep
+                    logits = self.forward(context[:, offset + kv_cache.length:], kv_cache=kv_cache)
                 
                 # Focus only on the last token's logits
                 logits = logits[:, -1, :]  # (batch_size, vocab_size)
                 
-                # Apply softmax to get probabilities
-                probs = F.softmax(logits, dim=-1)  # (batch_size, vocab_size)
-                
                 # Sample from the distribution
-                next_token = torch.multinomial(probs, num_samples=1)  # (batch_size, 1)
+                next_token = sampler(logits)  # (batch_size,)
                 
                 # Append the new token to the context
-                context = torch.cat([context, next_token], dim=1)  # (batch_size, seq_len + 1)
+                output.append(next_token)
         
         
         # Return the generated tokens as a list
         
-        return context
+        return output.tokens
 
         ### ========= TODO : END ========= ###
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint_path, map_location="cpu", **config_overrides):
+        """
+        Build a MiniGPT from a checkpoint saved by train.py (a dict with "model_state_dict").
+
+        The checkpoint only pickles a reference to the config class, so the architecture
+        (sizes, number of layers and heads, weight tying) is read back from the state dict.
+        config_overrides are passed on to MiniGPTConfig (e.g. fused_attention=True).
+        """
+        ckpt = torch.load(checkpoint_path, map_location=map_location, weights_only=False)
+        state_dict = ckpt["model_state_dict"]
+        config = MiniGPTConfig(**{**config_from_state_dict(state_dict), **config_overrides})
+        model = cls(config)
+        model.load_state_dict(state_dict)
+        return model.to(map_location)
+
+
+def config_from_state_dict(state_dict):
+    """
+    Recover the MiniGPTConfig fields describing the architecture from a MiniGPT state dict.
+    """
+    vocab_size, embed_dim = state_dict["vocab_embedding.weight"].shape
+    layers = {k.split(".")[1] for k in state_dict if k.startswith("transformer_layers.")}
+    head_prefix = "transformer_layers.0.attention.head_"
+    heads = {k[len(head_prefix) :].split(".")[0] for k in state_dict if k.startswith(head_prefix)}
+    return dict(
+        vocab_size=vocab_size,
+        embed_dim=embed_dim,
+        context_length=state_dict["positional_embedding.weight"].size(0),
+        num_layers=len(layers),
+        num_heads=len(heads),
+        feedforward_size=state_dict["transformer_layers.0.feedforward.fc1.weight"].size(0),
+        weight_tie=torch.equal(state_dict["head.weight"], state_dict["vocab_embedding.weight"]),
+    )
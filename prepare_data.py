@@ -0,0 +1,212 @@
+"""
+Tokenize a raw text corpus into the uint16 token files read by TinyStoriesDataset.
+
+Documents are streamed from .jsonl files (one JSON object per line, the text under --text-key)
+or .txt files (documents separated by <|endoftext|> lines, as in the TinyStories dumps), encoded
+with the tiktoken gpt2 encoding in a process pool, terminated by an EOT token and appended to
+fixed size shards:
+
+    out_dir/train-{run}-00000.bin, out_dir/train-{run}-00001.bin, ..., out_dir/test-{run}-00000.bin
+    out_dir/manifest.json  {"splits": {"train": [{"file", "num_tokens", "num_documents"}, ...]}}
+
+Only a bounded number of document chunks is in flight at any time, so memory does not depend on
+the corpus size. Every run writes new shard files (run is a timestamp and the pid) that no
+manifest lists until the new one replaces it, so readers only ever see complete shards; the
+shards of the previous manifest are deleted afterwards.
+
+Usage:
+    python prepare_data.py --train TinyStoriesV2-GPT4-train.txt --test TinyStoriesV2-GPT4-valid.txt \
+        --out-dir data --workers 16
+"""
+
+import argparse
+import json
+import os
+import time
+from collections import deque
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+import tiktoken
+
+
+EOT_TOKEN = 50256
+TXT_SEPARATOR = "<|endoftext|>"
+MANIFEST = "manifest.json"
+
+_encoder = None
+_encoder_error = None
+
+
+def read_documents(paths, text_key="text"):
+    """Stream the documents of .jsonl / .txt files, one string at a time."""
+    for path in paths:
+        path = Path(path)
+        with open(path, encoding="utf-8") as f:
+            if path.suffix == ".jsonl":
+                for line in f:
+                    if line.strip():
+                        text = json.loads(line)[text_key]
+                        if text.strip():
+                            yield text
+            else:
+                lines = []
+                for line in f:
+                    if line.strip() == TXT_SEPARATOR:
+                        text = "".join(lines).strip()
+                        if text:
+                            yield text
+                        lines = []
+                    else:
+                        lines.append(line)
+                text = "".join(lines).strip()
+                if text:
+                    yield text
+
+
+def chunked(documents, chunk_size):
+    chunk = []
+    for document in documents:
+        chunk.append(document)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _init_worker():
+    # an exception here would only kill the worker and the pool would start another one forever,
+    # it is raised by the first task instead so the run fails
+    global _encoder, _encoder_error
+    try:
+        _encoder = tiktoken.get_encoding("gpt2")
+    except Exception as e:
+        _encoder_error = e
+
+
+def encode_chunk(documents):
+    """Encode a list of documents into one uint16 array, each document followed by EOT."""
+    if _encoder is None:
+        raise RuntimeError("the worker could not load the gpt2 encoding") from _encoder_error
+    # special tokens in the raw text are encoded as plain text, EOT is only added between documents
+    encoded = _encoder.encode_ordinary_batch(documents, num_threads=1)
+    lengths = [len(tokens) + 1 for tokens in encoded]
+    out = np.empty(sum(lengths), dtype=np.uint16)
+    position = 0
+    for tokens, length in zip(encoded, lengths):
+        out[position : position + length - 1] = tokens
+        out[position + length - 1] = EOT_TOKEN
+        position += length
+    return out, len(documents)
+
+
+class ShardWriter:
+    """Append token arrays to out_dir/{split}-{run}-{index:05d}.bin files of shard_size tokens."""
+
+    def __init__(self, out_dir, split, shard_size, run):
+        self.out_dir = Path(out_dir)
+        self.split = split
+        self.shard_size = shard_size
+        self.run = run
+        self.shards = []
+        self._file = None
+
+    def _open(self):
+        name = f"{self.split}-{self.run}-{len(self.shards):05d}.bin"
+        self._file = open(self.out_dir / name, "wb")
+        self.shards.append({"file": name, "num_tokens": 0, "num_documents": 0})
+
+    def write(self, tokens, num_documents):
+        # documents are counted in the shard where their chunk starts
+        while len(tokens):
+            if self._file is None or self.shards[-1]["num_tokens"] == self.shard_size:
+                self.close()
+                self._open()
+            shard = self.shards[-1]
+            piece = tokens[: self.shard_size - shard["num_tokens"]]
+            piece.tofile(self._file)
+            shard["num_tokens"] += len(piece)
+            shard["num_documents"] += num_documents
+            num_documents = 0
+            tokens = tokens[len(piece) :]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def tokenize_split(pool, paths, writer, chunk_size, max_pending, text_key):
+    pending = deque()
+    num_tokens = 0
+    start = time.perf_counter()
+    for chunk in chunked(read_documents(paths, text_key), chunk_size):
+        pending.append(pool.apply_async(encode_chunk, (chunk,)))
+        # results are written in order, at most max_pending chunks are being encoded
+        while len(pending) >= max_pending or (pending and pending[0].ready()):
+            tokens, num_documents = pending.popleft().get()
+            writer.write(tokens, num_documents)
+            num_tokens += len(tokens)
+    while pending:
+        tokens, num_documents = pending.popleft().get()
+        writer.write(tokens, num_documents)
+        num_tokens += len(tokens)
+    writer.close()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{writer.split}: {num_tokens} tokens in {len(writer.shards)} shards, "
+        f"{elapsed:.1f}s ({num_tokens / max(elapsed, 1e-9):.0f} tokens/s)"
+    )
+    return writer.shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokenize a text corpus into uint16 shards")
+    parser.add_argument("--train", type=Path, nargs="+", default=[], help=".jsonl / .txt files")
+    parser.add_argument("--test", type=Path, nargs="+", default=[], help=".jsonl / .txt files")
+    parser.add_argument("--out-dir", type=Path, default=Path("data"))
+    parser.add_argument("--text-key", default="text", help="field holding the text in .jsonl")
+    parser.add_argument("--shard-size", type=int, default=100_000_000, help="tokens per shard")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="documents per task")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    # fail before any worker starts when the encoding cannot be loaded (this also caches its files)
+    tiktoken.get_encoding("gpt2")
+
+    args.out_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = args.out_dir / MANIFEST
+    manifest = {"splits": {}}
+    if manifest_path.exists():  # keep the splits that are not rebuilt
+        manifest = json.loads(manifest_path.read_text())
+    manifest.update(tokenizer="gpt2", dtype="uint16", eot_token=EOT_TOKEN)
+    previous = {split: list(shards) for split, shards in manifest["splits"].items()}
+    run = f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+
+    with Pool(args.workers, initializer=_init_worker) as pool:
+        for split in ("train", "test"):
+            paths = getattr(args, split)
+            if not paths:
+                continue
+            writer = ShardWriter(args.out_dir, split, args.shard_size, run)
+            manifest["splits"][split] = tokenize_split(
+                pool, paths, writer, args.chunk_size, 2 * args.workers, args.text_key
+            )
+
+    # written last and atomically, a reader never sees a manifest pointing to partial shards
+    tmp_path = manifest_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_path, manifest_path)
+
+    # the replaced shards are no longer listed anywhere
+    kept = {shard["file"] for shards in manifest["splits"].values() for shard in shards}
+    for shards in previous.values():
+        for shard in shards:
+            if shard["file"] not in kept:
+                (args.out_dir / shard["file"]).unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    main()
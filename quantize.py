@@ -0,0 +1,391 @@
+"""
+Weight only int8 / int4 quantization of MiniGPT for inference.
+
+Every nn.Linear and the vocabulary embedding are replaced by modules storing per output channel
+(per row for the embedding) quantized weights and a float scale. With weight tying the
+vocabulary embedding and the language modelling head share a single quantized matrix.
+
+Clipping ratios are calibrated per channel on a slice of test.bin: for every channel the ratio
+minimizing the error of the layer output on the calibration activations is kept.
+
+Usage:
+    python quantize.py --checkpoint pretrained_models/best_train_loss_checkpoint.pth --bits 8
+"""
+
+import argparse
+import dataclasses
+import math
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from config import MiniGPTConfig
+from model import MiniGPT
+
+
+CLIP_RATIOS = (1.0, 0.98, 0.95, 0.9, 0.85, 0.8, 0.75)
+MAX_CALIBRATION_ROWS = 512  # activation rows kept per layer for calibration
+
+
+def pack_int4(q):
+    """
+    Pack a (rows, cols) int8 tensor with values in [-8, 7] into (rows, ceil(cols / 2)) uint8,
+    even columns in the low nibble.
+    """
+    if q.size(1) % 2:
+        q = F.pad(q, (0, 1))
+    q = (q & 0xF).to(torch.uint8)
+    return q[:, 0::2] | (q[:, 1::2] << 4)
+
+
+def unpack_int4(packed, cols):
+    """Inverse of pack_int4, returns a (rows, cols) int8 tensor."""
+    low = (packed & 0xF).to(torch.int8)
+    high = (packed >> 4).to(torch.int8)
+    q = torch.stack([low, high], dim=-1).flatten(-2)[..., :cols]
+    return (q ^ 8) - 8  # sign extend the 4 bit values
+
+
+def quantize_per_channel(weight, bits=8, clip_ratio=1.0):
+    """
+    Symmetric per output channel (per row) quantization.
+
+    Args:
+    weight : torch.Tensor
+        A tensor of shape (out_features, in_features).
+    bits : int
+        8 or 4.
+    clip_ratio : float or torch.Tensor
+        Fraction of the absolute maximum of every row mapped to the largest quantized value,
+        a float or a tensor of shape (out_features,).
+
+    Output:
+    Tuple[torch.Tensor, torch.Tensor]
+        The int8 values (out_features, in_features) and the float scales (out_features,).
+    """
+    qmax = 2 ** (bits - 1) - 1
+    absmax = weight.detach().abs().amax(dim=1).float() * clip_ratio
+    scale = absmax.clamp(min=1e-8) / qmax
+    q = torch.round(weight.detach().float() / scale.unsqueeze(1))
+    q = q.clamp_(-qmax - 1, qmax).to(torch.int8)
+    return q, scale
+
+
+def _int8_linear(x, weight, scale, bias=None):
+    """x @ (weight * scale)^T + bias without materializing the float weight when possible."""
+    shape = x.shape
+    x = x.reshape(-1, shape[-1])
+    out = None
+    if x.device.type == "cpu" and hasattr(torch, "_weight_int8pack_mm"):
+        try:
+            out = torch._weight_int8pack_mm(x, weight, scale.to(x.dtype))
+        except RuntimeError:
+            out = None  # dtype / shape not supported by this build
+    if out is None:
+        out = F.linear(x, weight.to(x.dtype)) * scale.to(x.dtype)
+    if bias is not None:
+        out = out + bias
+    return out.reshape(*shape[:-1], out.size(-1))
+
+
+class QuantizedLinear(nn.Module):
+    """
+    Inference only nn.Linear with int8 (or packed int4) weights and per output channel scales.
+    """
+
+    def __init__(self, in_features, out_features, bias=True, bits=8):
+        super().__init__()
+        if bits not in (4, 8):
+            raise ValueError("bits must be 8 or 4")
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        cols = in_features if bits == 8 else math.ceil(in_features / 2)
+        dtype = torch.int8 if bits == 8 else torch.uint8
+        self.register_buffer("weight", torch.zeros(out_features, cols, dtype=dtype))
+        self.register_buffer("scale", torch.ones(out_features))
+        if bias:
+            self.register_buffer("bias", torch.zeros(out_features))
+        else:
+            self.bias = None
+
+    @classmethod
+    def from_linear(cls, linear, bits=8, clip_ratio=1.0):
+        module = cls(linear.in_features, linear.out_features, linear.bias is not None, bits)
+        q, scale = quantize_per_channel(linear.weight, bits, clip_ratio)
+        module.weight.copy_(q if bits == 8 else pack_int4(q))
+        module.scale.copy_(scale)
+        if linear.bias is not None:
+            module.bias.copy_(linear.bias.detach())
+        return module.to(linear.weight.device)
+
+    def int_weight(self):
+        if self.bits == 8:
+            return self.weight
+        return unpack_int4(self.weight, self.in_features)
+
+    def dequantize(self):
+        return self.int_weight().float() * self.scale.unsqueeze(1)
+
+    def forward(self, x):
+        return _int8_linear(x, self.int_weight(), self.scale, self.bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}"
+
+
+class QuantizedEmbedding(nn.Module):
+    """
+    Inference only nn.Embedding with int8 (or packed int4) rows and one scale per row.
+    Only the looked up rows are dequantized.
+    """
+
+    def __init__(self, num_embeddings, embedding_dim, bits=8):
+        super().__init__()
+        if bits not in (4, 8):
+            raise ValueError("bits must be 8 or 4")
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.bits = bits
+        cols = embedding_dim if bits == 8 else math.ceil(embedding_dim / 2)
+        dtype = torch.int8 if bits == 8 else torch.uint8
+        self.register_buffer("weight", torch.zeros(num_embeddings, cols, dtype=dtype))
+        self.register_buffer("scale", torch.ones(num_embeddings))
+
+    @classmethod
+    def from_embedding(cls, embedding, bits=8, clip_ratio=1.0):
+        module = cls(embedding.num_embeddings, embedding.embedding_dim, bits)
+        q, scale = quantize_per_channel(embedding.weight, bits, clip_ratio)
+        module.weight.copy_(q if bits == 8 else pack_int4(q))
+        module.scale.copy_(scale)
+        return module.to(embedding.weight.device)
+
+    def int_weight(self):
+        if self.bits == 8:
+            return self.weight
+        return unpack_int4(self.weight, self.embedding_dim)
+
+    def forward(self, x):
+        rows = self.weight[x]
+        if self.bits == 4:
+            rows = unpack_int4(rows, self.embedding_dim)
+        return rows.float() * self.scale[x].unsqueeze(-1)
+
+    def extra_repr(self):
+        return f"{self.num_embeddings}, {self.embedding_dim}, bits={self.bits}"
+
+
+class QuantizedTiedHead(nn.Module):
+    """
+    Language modelling head reusing the quantized vocabulary embedding (weight tying), only
+    its bias is stored here.
+    """
+
+    def __init__(self, embedding, bias=True):
+        super().__init__()
+        self._embedding = (embedding,)  # tuple: not registered as a submodule
+        if bias:
+            self.register_buffer("bias", torch.zeros(embedding.num_embeddings))
+        else:
+            self.bias = None
+
+    def forward(self, x):
+        embedding = self._embedding[0]
+        return _int8_linear(x, embedding.int_weight(), embedding.scale, self.bias)
+
+
+def _replace(model, name, module):
+    parent_name, _, child = name.rpartition(".")
+    parent = model.get_submodule(parent_name) if parent_name else model
+    setattr(parent, child, module)
+
+
+@torch.no_grad()
+def calibrate(model, tokens, bits=8, context_length=None, ratios=CLIP_RATIOS):
+    """
+    Pick, for every output channel of every nn.Linear, the clip ratio minimizing the squared
+    error of its output on the activations seen while running tokens through the model.
+
+    Args:
+    model : MiniGPT
+        The float model.
+    tokens : torch.Tensor
+        A 1D tensor of calibration tokens.
+    bits : int
+        Target number of bits.
+
+    Output:
+    Dict[str, torch.Tensor]
+        Module name -> clip ratios of shape (out_features,).
+    """
+    model.eval()
+    context_length = context_length or model.context_length
+    inputs = {}
+    hooks = []
+    for name, module in model.named_modules():
+        if isinstance(module, nn.Linear):
+
+            def hook(module, args, name=name):
+                x = args[0].reshape(-1, args[0].size(-1)).float()
+                inputs.setdefault(name, []).append(x)
+
+            hooks.append(module.register_forward_pre_hook(hook))
+
+    num_windows = max(1, tokens.numel() // context_length)
+    x = tokens[: num_windows * context_length].view(num_windows, -1)
+    device = next(model.parameters()).device
+    model(x.to(device))
+    for h in hooks:
+        h.remove()
+
+    clip_ratios = {}
+    for name, xs in inputs.items():
+        x = torch.cat(xs)
+        if x.size(0) > MAX_CALIBRATION_ROWS:
+            x = x[:: math.ceil(x.size(0) / MAX_CALIBRATION_ROWS)]
+        weight = model.get_submodule(name).weight.float()
+        errors = []
+        for ratio in ratios:
+            q, scale = quantize_per_channel(weight, bits, ratio)
+            diff = weight - q.float() * scale.unsqueeze(1)
+            errors.append((x @ diff.t()).pow(2).sum(dim=0))  # (out_features,)
+        best = torch.stack(errors).argmin(dim=0)
+        clip_ratios[name] = torch.tensor(ratios, device=best.device)[best]
+    return clip_ratios
+
+
+def quantize_model(model, bits=8, clip_ratios=None):
+    """
+    Replace, in place, the nn.Linear layers and the vocabulary embedding of a MiniGPT by their
+    quantized versions. With weight tying the head reuses the quantized embedding.
+
+    Args:
+    model : MiniGPT
+        The float model, it is modified in place.
+    bits : int
+        8 or 4.
+    clip_ratios : Dict[str, torch.Tensor], optional
+        Output of calibrate, plain absmax scaling for the missing layers.
+
+    Output:
+    MiniGPT
+        The quantized model.
+    """
+    clip_ratios = clip_ratios or {}
+    tied = model.head.weight is model.vocab_embedding.weight
+    embedding = QuantizedEmbedding.from_embedding(
+        model.vocab_embedding, bits, clip_ratios.get("head", 1.0) if tied else 1.0
+    )
+    if tied:
+        head = QuantizedTiedHead(embedding, model.head.bias is not None)
+        if model.head.bias is not None:
+            head.bias.copy_(model.head.bias.detach())
+        _replace(model, "head", head.to(embedding.weight.device))
+
+    linears = [
+        name for name, module in model.named_modules() if isinstance(module, nn.Linear)
+    ]
+    for name in linears:
+        linear = model.get_submodule(name)
+        _replace(
+            model, name, QuantizedLinear.from_linear(linear, bits, clip_ratios.get(name, 1.0))
+        )
+    _replace(model, "vocab_embedding", embedding)
+    model.quantization_bits = bits
+    return model
+
+
+def save_quantized(model, path):
+    """
+    Save a quantized model together with its architecture (model.config).
+    """
+    config = {f.name: getattr(model.config, f.name) for f in dataclasses.fields(model.config)}
+    torch.save(
+        {
+            "quantized_state_dict": model.state_dict(),
+            "bits": model.quantization_bits,
+            "config": config,
+        },
+        path,
+    )
+
+
+def load_quantized(path, map_location="cpu"):
+    """
+    Load a model saved with save_quantized.
+    """
+    ckpt = torch.load(path, map_location=map_location, weights_only=False)
+    model = MiniGPT(MiniGPTConfig(**ckpt["config"]))
+    quantize_model(model, ckpt["bits"])
+    model.load_state_dict(ckpt["quantized_state_dict"])
+    return model.to(map_location).eval()
+
+
+def load_tokens(data_path, start, num_tokens):
+    """Read num_tokens tokens of a uint16 .bin file starting at start as a 1D LongTensor."""
+    data = np.memmap(data_path, dtype=np.uint16, mode="r")
+    return torch.from_numpy(data[start : start + num_tokens].astype(np.int64))
+
+
+@torch.no_grad()
+def perplexity(model, tokens, context_length, batch_size=8):
+    """
+    Token weighted perplexity of the model over non overlapping windows of tokens.
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    num_windows = (tokens.numel() - 1) // context_length
+    x = tokens[: num_windows * context_length].view(num_windows, context_length)
+    y = tokens[1 : num_windows * context_length + 1].view(num_windows, context_length)
+    total_loss = 0.0
+    for i in range(0, num_windows, batch_size):
+        xb, yb = x[i : i + batch_size].to(device), y[i : i + batch_size].to(device)
+        logits = model(xb)
+        total_loss += F.cross_entropy(
+            logits.flatten(0, 1).float(), yb.flatten(), reduction="sum"
+        ).item()
+    return math.exp(total_loss / y.numel())
+
+
+def model_size_bytes(model):
+    tensors = {t.data_ptr(): t for t in model.state_dict().values()}
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize a MiniGPT checkpoint for inference")
+    parser.add_argument("--checkpoint", type=Path, required=True)
+    parser.add_argument("--data", type=Path, default=MiniGPTConfig.path_to_data)
+    parser.add_argument("--bits", type=int, default=8, choices=(8, 4))
+    parser.add_argument("--calibration-tokens", type=int, default=8 * 512)
+    parser.add_argument("--eval-tokens", type=int, default=64 * 512)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--out", type=Path, default=None)
+    args = parser.parse_args()
+
+    model = MiniGPT.from_checkpoint(args.checkpoint).eval()
+    test_path = args.data / "test.bin"
+    calibration = load_tokens(test_path, 0, args.calibration_tokens)
+    evaluation = load_tokens(test_path, args.calibration_tokens, args.eval_tokens)
+
+    fp32_size = model_size_bytes(model)
+    fp32_ppl = perplexity(model, evaluation, model.context_length, args.batch_size)
+
+    clip_ratios = calibrate(model, calibration, args.bits)
+    quantize_model(model, args.bits, clip_ratios)
+    q_size = model_size_bytes(model)
+    q_ppl = perplexity(model, evaluation, model.context_length, args.batch_size)
+
+    print(f"fp32 : {fp32_size / 2**20:8.1f} MiB  perplexity {fp32_ppl:.3f}")
+    print(f"int{args.bits} : {q_size / 2**20:8.1f} MiB  perplexity {q_ppl:.3f}")
+
+    if args.out is not None:
+        save_quantized(model, args.out)
+        print(f"saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
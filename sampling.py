@@ -0,0 +1,397 @@
+"""
+Token sampling used by the generate functions.
+
+Temperature, top-k and nucleus (top-p) filtering are built on torch.topk (partial selection)
+instead of sorting the whole vocabulary, and every request can get its own seeded generator so
+its output is reproducible whatever else is in the batch.
+"""
+
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from config import SamplingConfig
+
+
+NUCLEUS_INITIAL_CANDIDATES = 64  # first topk size tried when searching the nucleus
+UNIFORM_BLOCK = 4096  # uniforms drawn at once by the alias sampler
+
+
+def make_generator(seed: Optional[int], device="cpu") -> Optional[torch.Generator]:
+    if seed is None:
+        return None
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    return generator
+
+
+class TokenBuffer:
+    """
+    Preallocated (batch_size, capacity) buffer the generated tokens are written into, so the
+    output does not have to be reallocated with torch.cat at every step.
+    """
+
+    def __init__(self, initial, max_new_tokens):
+        """
+        Args:
+        initial : torch.Tensor
+            A tensor of shape (batch_size, seq_len) with the first values (e.g. the prompt).
+        max_new_tokens : int
+            Number of columns that can be appended.
+        """
+        batch_size, seq_len = initial.shape
+        self.data = initial.new_empty(batch_size, seq_len + max_new_tokens)
+        self.data[:, :seq_len] = initial
+        self.length = seq_len
+
+    @property
+    def tokens(self):
+        """View of the filled part of the buffer, (batch_size, length)."""
+        return self.data[:, : self.length]
+
+    def append(self, values):
+        """
+        Args:
+        values : torch.Tensor or scalar
+            New column, a tensor of shape (batch_size,) or (batch_size, 1).
+        """
+        if self.length == self.data.size(1):
+            raise RuntimeError("TokenBuffer is full")
+        if isinstance(values, torch.Tensor):
+            values = values.view(-1)
+        self.data[:, self.length] = values
+        self.length += 1
+
+    def truncate(self, length):
+        """Forget everything after the first length columns."""
+        self.length = length
+
+    def index_select(self, index):
+        self.data = self.data.index_select(0, index)
+
+
+class Sampler:
+    """
+    Samples the next token of every row of a batch, each row following its own SamplingConfig.
+    """
+
+    def __init__(
+        self,
+        configs: Union[None, SamplingConfig, Sequence[SamplingConfig]] = None,
+        batch_size: int = 1,
+        device="cpu",
+    ):
+        """
+        Args:
+        configs : SamplingConfig or Sequence[SamplingConfig], optional
+            One config shared by the batch_size rows, or one config per row.
+        batch_size : int
+            Number of rows when a single (or no) config is given.
+        device : torch.device
+            Device of the logits.
+        """
+        if configs is None:
+            configs = SamplingConfig()
+        if isinstance(configs, SamplingConfig):
+            configs = [configs] * batch_size
+        self.temperature = torch.tensor(
+            [c.temperature for c in configs], dtype=torch.float, device=device
+        )
+        self.top_k = torch.tensor(
+            [c.top_k or 0 for c in configs], dtype=torch.long, device=device
+        )
+        self.top_p = torch.tensor(
+            [1.0 if c.top_p is None else c.top_p for c in configs],
+            dtype=torch.float,
+            device=device,
+        )
+        # a shared seed still gives every row its own generator (and its own stream)
+        self.generators = [make_generator(c.seed, device) for c in configs]
+
+    def index_select(self, index):
+        """Keep only the rows in index (a 1D LongTensor)."""
+        self.temperature = self.temperature[index]
+        self.top_k = self.top_k[index]
+        self.top_p = self.top_p[index]
+        self.generators = [self.generators[i] for i in index.tolist()]
+
+    def _candidates(self, logits):
+        """
+        Restrict every row to its top-k / nucleus candidates.
+
+        Both filters are computed on the (temperature scaled) full distribution and a token is
+        kept if it passes both. The nucleus is found by growing a topk selection until it covers
+        top_p of the probability mass, which is much cheaper than sorting the whole vocabulary.
+        Rows without any filter keep the whole vocabulary and are left out of the search, so they
+        never force it up to a full vocabulary topk.
+
+        Output:
+        Tuple[torch.Tensor, Optional[torch.Tensor]]
+            Candidate logits (batch_size, k), -inf for the filtered ones, sorted in decreasing
+            order, and their token ids (batch_size, k). When some rows are not filtered, the
+            logits of the whole vocabulary (-inf for the filtered tokens) and None.
+        """
+        filtered = (self.top_k > 0) | (self.top_p < 1.0)
+        if not bool(filtered.any()):
+            return logits, None
+        if bool(filtered.all()):
+            return self._filter(logits, self.top_k, self.top_p)
+        rows = filtered.nonzero().squeeze(1)
+        values, ids = self._filter(logits[rows], self.top_k[rows], self.top_p[rows])
+        logits = logits.clone()
+        logits[rows] = torch.full_like(logits[rows], float("-inf")).scatter_(1, ids, values)
+        return logits, None
+
+    @staticmethod
+    def _filter(logits, top_k, top_p):
+        """_candidates of rows that all have a top-k or a top-p filter."""
+        vocab_size = logits.size(-1)
+        use_top_p = bool((top_p < 1.0).any())
+        row_k = torch.where(top_k > 0, top_k, torch.full_like(top_k, vocab_size))
+        row_k = row_k.clamp(max=vocab_size)
+        k_max = int(row_k.max())
+
+        if not use_top_p:
+            values, ids = torch.topk(logits, k_max, dim=-1)
+        else:
+            lse = torch.logsumexp(logits, dim=-1, keepdim=True)
+            k = min(k_max, NUCLEUS_INITIAL_CANDIDATES)
+            while True:
+                values, ids = torch.topk(logits, k, dim=-1)
+                probs = torch.exp(values - lse)
+                cumulative = probs.cumsum(dim=-1)
+                covered = (cumulative[:, -1] >= top_p) | (row_k <= k)
+                if k == k_max or bool(covered.all()):
+                    break
+                k = min(k_max, 4 * k)
+            # drop a token once the mass of the tokens before it reaches top_p
+            values = values.masked_fill(cumulative - probs >= top_p.unsqueeze(1), float("-inf"))
+
+        rank = torch.arange(values.size(1), device=logits.device)
+        values = values.masked_fill(rank.unsqueeze(0) >= row_k.unsqueeze(1), float("-inf"))
+        return values, ids
+
+    def uniform(self):
+        """One uniform sample in [0, 1) per row, drawn from the row's generator, (batch_size,)."""
+        device = self.temperature.device
+        return torch.stack(
+            [torch.rand((), generator=g, device=device) for g in self.generators]
+        )
+
+    def _draw(self, probs):
+        """Draw one index per row of probs (batch_size, n)."""
+        if all(g is None for g in self.generators):
+            return torch.multinomial(probs, num_samples=1).squeeze(1)
+        # inverse CDF with one uniform per row drawn from that row's generator
+        uniforms = self.uniform()
+        cdf = probs.cumsum(dim=-1)
+        target = (uniforms * cdf[:, -1]).unsqueeze(1)
+        index = torch.searchsorted(cdf, target, right=True).squeeze(1)
+        return index.clamp_(max=probs.size(1) - 1)
+
+    def probs(self, logits):
+        """
+        Distribution the sampler draws from, after temperature, top-k and top-p.
+
+        Args:
+        logits : torch.Tensor
+            A tensor of shape (batch_size, vocab_size) with the next token logits.
+
+        Output:
+        torch.Tensor
+            A tensor of shape (batch_size, vocab_size), one-hot for greedy rows.
+        """
+        logits = logits.float()
+        greedy = self.temperature <= 0
+        logits = logits / self.temperature.clamp(min=1e-6).unsqueeze(1)
+        values, ids = self._candidates(logits)
+        probs = F.softmax(values, dim=-1)
+        if bool(greedy.any()):
+            one_hot = F.one_hot(values.argmax(dim=-1), values.size(-1)).to(probs.dtype)
+            probs = torch.where(greedy.unsqueeze(1), one_hot, probs)
+        if ids is None:
+            return probs
+        return torch.zeros_like(logits).scatter_(1, ids, probs)
+
+    def sample_from(self, probs):
+        """
+        Draw one token per row of a (batch_size, vocab_size) distribution, e.g. from probs().
+
+        Output:
+        torch.Tensor
+            A tensor of shape (batch_size,) containing the sampled tokens.
+        """
+        return self._draw(probs)
+
+    def __call__(self, logits):
+        """
+        Args:
+        logits : torch.Tensor
+            A tensor of shape (batch_size, vocab_size) with the next token logits.
+
+        Output:
+        torch.Tensor
+            A tensor of shape (batch_size,) containing the sampled tokens.
+        """
+        logits = logits.float()
+        greedy = self.temperature <= 0
+        logits = logits / self.temperature.clamp(min=1e-6).unsqueeze(1)
+        values, ids = self._candidates(logits)
+        probs = F.softmax(values, dim=-1)
+        choice = self._draw(probs)
+        if bool(greedy.any()):
+            choice = torch.where(greedy, values.argmax(dim=-1), choice)
+        if ids is None:
+            return choice
+        return ids.gather(1, choice.unsqueeze(1)).squeeze(1)
+
+
+class AliasTable:
+    """
+    Walker alias table (Vose's construction) of a discrete distribution: built with a few numpy
+    passes (O(n log n)) and O(1) per sample.
+    """
+
+    def __init__(self, probs):
+        """
+        Args:
+        probs : np.ndarray
+            A 1D array of non negative weights, normalized here.
+        """
+        probs = np.asarray(probs, dtype=np.float64)
+        n = len(probs)
+        scaled = probs * (n / probs.sum())
+        prob = np.ones(n)
+        alias = np.arange(n)
+        # Vose's pairing without the Python loop: every small column is topped up by the large one
+        # currently donating, and a large one becomes small once the deficits it served exceed its
+        # excess (its own deficit then goes to the next large one). With the deficits and excesses
+        # laid out as cumulative sums, both are found by a binary search.
+        small = np.flatnonzero(scaled < 1.0)
+        large = np.flatnonzero(scaled >= 1.0)
+        deficit_end = np.cumsum(1.0 - scaled[small])
+        deficit_start = np.concatenate(([0.0], deficit_end))[:-1]  # empty without small columns
+        excess_end = np.cumsum(scaled[large] - 1.0)
+
+        donor = np.searchsorted(excess_end, deficit_start, side="left")
+        served = donor < len(large)
+        prob[small[served]] = scaled[small[served]]
+        alias[small[served]] = large[donor[served]]
+
+        tip = np.searchsorted(deficit_end, excess_end, side="right")
+        tipped = np.flatnonzero((tip < len(small)) & (np.arange(len(large)) + 1 < len(large)))
+        prob[large[tipped]] = 1.0 - (deficit_end[tip[tipped]] - excess_end[tipped])
+        alias[large[tipped]] = large[tipped + 1]
+        # columns left out are 1 up to rounding errors
+        self.n = n
+        self.prob = prob.astype(np.float32)
+        self.alias = alias.astype(np.int32)
+
+    def sample(self, u):
+        """
+        Draw one index from a single uniform u in [0, 1): its integer part (times n) picks a
+        column and its fractional part decides between the column and its alias.
+        """
+        u = u * self.n
+        i = int(u)
+        return i if u - i < self.prob[i] else int(self.alias[i])
+
+
+class BigramAliasSampler:
+    """
+    Fast sampling from a BigramLanguageModel.
+
+    The next token distribution only depends on the previous token, so its alias table is built
+    the first time that token is seen and kept in a bounded LRU cache (plus an unbounded set of
+    precomputed tables for hot tokens); every sample is then O(1) and never touches the model.
+    The tables are a snapshot of the weights: call clear() after updating the model.
+    """
+
+    def __init__(self, model, temperature=1.0, cache_size=256, seed=None):
+        """
+        Args:
+        model : BigramLanguageModel
+            The model to sample from.
+        temperature : float
+            Sampling temperature (> 0), baked into the tables.
+        cache_size : int
+            Maximum number of tables kept in the LRU cache (about 400KB each for GPT2's vocabulary).
+        seed : int, optional
+            Seed of the sampler's random stream.
+        """
+        if temperature <= 0:
+            raise ValueError("temperature must be > 0")
+        self.model = model
+        self.temperature = temperature
+        self.cache_size = cache_size
+        self.rng = np.random.default_rng(seed)
+        self._uniforms = []
+        self._tables = OrderedDict()
+        self._pinned = {}
+
+    @torch.no_grad()
+    def _build(self, tokens: List[int]) -> List[AliasTable]:
+        weight = self.model.embeddings.weight
+        embeddings = weight[torch.tensor(tokens, device=weight.device)]
+        logits = self.model.linear(embeddings).double() / self.temperature
+        probs = torch.softmax(logits, dim=-1).cpu().numpy()
+        return [AliasTable(p) for p in probs]
+
+    def table(self, token: int) -> AliasTable:
+        table = self._pinned.get(token)
+        if table is not None:
+            return table
+        table = self._tables.get(token)
+        if table is not None:
+            self._tables.move_to_end(token)
+            return table
+        table = self._build([token])[0]
+        self._tables[token] = table
+        if len(self._tables) > self.cache_size:
+            self._tables.popitem(last=False)
+        return table
+
+    def precompute(self, tokens: Iterable[int], batch_size=256):
+        """
+        Build and pin the tables of tokens (e.g. the most frequent ones, from np.bincount of the
+        training data); pinned tables are never evicted.
+        """
+        tokens = [t for t in dict.fromkeys(int(t) for t in tokens) if t not in self._pinned]
+        for i in range(0, len(tokens), batch_size):
+            chunk = tokens[i : i + batch_size]
+            for token, table in zip(chunk, self._build(chunk)):
+                self._pinned[token] = table
+                self._tables.pop(token, None)
+
+    def clear(self):
+        self._tables.clear()
+        self._pinned.clear()
+
+    def _uniform(self):
+        if not self._uniforms:
+            self._uniforms = self.rng.random(UNIFORM_BLOCK).tolist()
+        return self._uniforms.pop()
+
+    def generate(self, context, max_new_tokens=100):
+        """
+        Same interface as BigramLanguageModel.generate.
+
+        Args:
+        context : torch.Tensor
+            A 1D tensor with the prompt tokens.
+        max_new_tokens : int
+            The number of tokens to generate.
+
+        Output:
+        torch.Tensor
+            A tensor of shape (1, prompt_len + max_new_tokens).
+        """
+        tokens = context.flatten().tolist()
+        token = tokens[-1]
+        for _ in range(max_new_tokens):
+            token = self.table(token).sample(self._uniform())
+            tokens.append(token)
+        return torch.tensor(tokens, dtype=torch.long, device=context.device).unsqueeze(0)
@@ -0,0 +1,376 @@
+"""
+Local inference server for MiniGPT with dynamic batching.
+
+Concurrent generate requests are queued and gathered into micro batches (up to max_batch_size
+requests, waiting at most max_wait_ms after the first one) that are decoded together with
+generation.batched_decode on a single model instance. A batch runs until all of its sequences
+are done; requests arriving meanwhile form the next batch.
+
+Endpoints:
+    POST /generate  {"prompt": str, "max_new_tokens": int, "temperature": float, "top_k": int,
+                     "top_p": float, "seed": int, "stream": bool}
+                    stream=true answers with newline delimited JSON, one line per token.
+                    Invalid parameters are a 400, a failed batch a 500 (or a final
+                    {"error": ...} line once a stream has started).
+    GET  /metrics   queue / batching / latency metrics.
+    GET  /health
+
+Usage:
+    python server.py --checkpoint pretrained_models/best_train_loss_checkpoint.pth --port 8000
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional
+
+import tiktoken
+import torch
+
+from config import SamplingConfig
+from generation import EOT_TOKEN, IncrementalDetokenizer, batched_decode
+from model import MiniGPT
+from quantize import load_quantized
+
+
+class GenerationError(RuntimeError):
+    """The batch a request was decoded in failed."""
+
+
+@dataclass
+class GenerationRequest:
+    prompt: List[int]
+    max_new_tokens: int
+    sampling: SamplingConfig
+    # generated tokens, then None at the end or the exception that failed the batch
+    tokens: asyncio.Queue = field(default_factory=asyncio.Queue)
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    started_at: Optional[float] = None
+    first_token_at: Optional[float] = None
+
+
+class Metrics:
+    """Counters plus a window of recent latencies (in seconds)."""
+
+    def __init__(self, window=1000):
+        self.requests = 0
+        self.completed = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.generated_tokens = 0
+        self.queue_wait = deque(maxlen=window)
+        self.time_to_first_token = deque(maxlen=window)
+        self.latency = deque(maxlen=window)
+
+    @staticmethod
+    def _summary(values):
+        if not values:
+            return {}
+        ordered = sorted(values)
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+        return {
+            "mean_ms": 1000 * sum(ordered) / len(ordered),
+            "p50_ms": 1000 * pick(0.5),
+            "p95_ms": 1000 * pick(0.95),
+        }
+
+    def as_dict(self, queue_depth, active):
+        return {
+            "requests": self.requests,
+            "completed": self.completed,
+            "active": active,
+            "queue_depth": queue_depth,
+            "batches": self.batches,
+            "mean_batch_size": self.batched_requests / self.batches if self.batches else 0.0,
+            "generated_tokens": self.generated_tokens,
+            "queue_wait": self._summary(self.queue_wait),
+            "time_to_first_token": self._summary(self.time_to_first_token),
+            "latency": self._summary(self.latency),
+        }
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class InferenceServer:
+    def __init__(
+        self,
+        model,
+        tokenizer=None,
+        max_batch_size=8,
+        max_wait_ms=10.0,
+        max_new_tokens_limit=1024,
+    ):
+        self.model = model.eval()
+        self.tokenizer = tokenizer or tiktoken.get_encoding("gpt2")
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_new_tokens_limit = max_new_tokens_limit
+        self.metrics = Metrics()
+        self.active = 0
+        self._queue = None
+        # a single thread owns the model, batches run one after the other
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, request: GenerationRequest):
+        self.metrics.requests += 1
+        await self._queue.put(request)
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _run_batch(self, batch, loop):
+        """Decode a batch in the model thread, pushing the tokens to the request queues."""
+        now = time.perf_counter()
+        for request in batch:
+            request.started_at = now
+        decoder = batched_decode(
+            self.model,
+            [r.prompt for r in batch],
+            [r.max_new_tokens for r in batch],
+            EOT_TOKEN,
+            [r.sampling for r in batch],
+        )
+        for rows, next_tokens in decoder:
+            for i, token in zip(rows.tolist(), next_tokens.tolist()):
+                loop.call_soon_threadsafe(batch[i].tokens.put_nowait, token)
+        for request in batch:
+            loop.call_soon_threadsafe(request.tokens.put_nowait, None)
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            self.metrics.batches += 1
+            self.metrics.batched_requests += len(batch)
+            try:
+                await loop.run_in_executor(self._executor, self._run_batch, batch, loop)
+            except Exception as e:  # keep serving, fail the requests of this batch
+                print(f"batch failed: {e!r}")
+                for request in batch:
+                    request.tokens.put_nowait(e)
+
+    async def generate(self, request: GenerationRequest):
+        """Yield (token, text) pairs of a request; finishes the metrics bookkeeping at the end."""
+        self.active += 1
+        detokenizer = IncrementalDetokenizer(self.tokenizer)
+        try:
+            await self.submit(request)
+            while True:
+                token = await request.tokens.get()
+                if token is None:
+                    break
+                if isinstance(token, Exception):
+                    raise GenerationError(f"generation failed: {token!r}") from token
+                if request.first_token_at is None:
+                    request.first_token_at = time.perf_counter()
+                    self.metrics.queue_wait.append(request.started_at - request.enqueued_at)
+                    self.metrics.time_to_first_token.append(
+                        request.first_token_at - request.enqueued_at
+                    )
+                self.metrics.generated_tokens += 1
+                text = "" if token == EOT_TOKEN else detokenizer.push(token)
+                yield token, text
+            text = detokenizer.flush()
+            if text:
+                yield None, text
+        finally:
+            self.active -= 1
+            self.metrics.completed += 1
+            self.metrics.latency.append(time.perf_counter() - request.enqueued_at)
+
+    def parse_request(self, body):
+        """GenerationRequest of a /generate body, raises ValueError (a 400) when it is invalid."""
+        prompt = body.get("prompt", "")
+        if isinstance(prompt, str):
+            tokens = self.tokenizer.encode(prompt)
+        else:
+            tokens = list(prompt)
+            vocab_size = self.model.config.vocab_size
+            for token in tokens:
+                if not _is_int(token) or not 0 <= token < vocab_size:
+                    raise ValueError(
+                        f"prompt tokens must be integers in [0, {vocab_size}), got {token!r}"
+                    )
+        if not tokens:
+            tokens = [EOT_TOKEN]  # unconditional generation
+        max_new_tokens = body.get("max_new_tokens", 100)
+        if not _is_int(max_new_tokens) or max_new_tokens < 0:
+            raise ValueError("max_new_tokens must be a non negative integer")
+        temperature = body.get("temperature", 1.0)
+        if not _is_number(temperature) or not 0 <= temperature < math.inf:
+            raise ValueError("temperature must be a finite number >= 0")
+        top_k = body.get("top_k")
+        if top_k is not None and (not _is_int(top_k) or top_k < 1):
+            raise ValueError("top_k must be an integer >= 1")
+        top_p = body.get("top_p")
+        if top_p is not None and (not _is_number(top_p) or not 0 < top_p <= 1):
+            raise ValueError("top_p must be a number in (0, 1]")
+        seed = body.get("seed")
+        if seed is not None and (not _is_int(seed) or not 0 <= seed < 2**63):
+            raise ValueError("seed must be an integer in [0, 2**63)")
+        sampling = SamplingConfig(
+            temperature=float(temperature),
+            top_k=top_k,
+            top_p=None if top_p is None else float(top_p),
+            seed=seed,
+        )
+        return GenerationRequest(tokens, min(max_new_tokens, self.max_new_tokens_limit), sampling)
+
+    # ------------------------------------------------------------------ HTTP
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            if len(request_line) < 2:
+                return
+            method, path = request_line[0], request_line[1]
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "GET" and path == "/health":
+                await self._send_json(writer, 200, {"status": "ok"})
+            elif method == "GET" and path == "/metrics":
+                await self._send_json(
+                    writer, 200, self.metrics.as_dict(self._queue.qsize(), self.active)
+                )
+            elif method == "POST" and path == "/generate":
+                try:
+                    payload = json.loads(body or b"{}")
+                    request = self.parse_request(payload)
+                except (ValueError, TypeError) as e:
+                    await self._send_json(writer, 400, {"error": str(e)})
+                    return
+                if payload.get("stream", False):
+                    await self._stream(writer, request)
+                else:
+                    tokens, pieces = [], []
+                    try:
+                        async for token, text in self.generate(request):
+                            if token is not None:
+                                tokens.append(token)
+                            pieces.append(text)
+                    except GenerationError as e:
+                        await self._send_json(writer, 500, {"error": str(e)})
+                        return
+                    await self._send_json(
+                        writer, 200, {"text": "".join(pieces), "tokens": tokens}
+                    )
+            else:
+                await self._send_json(writer, 404, {"error": "not found"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _send_json(self, writer, status, payload):
+        body = json.dumps(payload).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+
+    async def _stream(self, writer, request):
+        pairs = self.generate(request)
+        # the status line waits for the first token, a batch failing before it is still a 500
+        try:
+            first = await pairs.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except GenerationError as e:
+            await self._send_json(writer, 500, {"error": str(e)})
+            return
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: application/x-ndjson\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+
+        async def send(payload):
+            line = json.dumps(payload).encode() + b"\n"
+            writer.write(b"%x\r\n%s\r\n" % (len(line), line))
+            await writer.drain()
+
+        if first is not None:
+            await send({"token": first[0], "text": first[1]})
+            try:
+                async for token, text in pairs:
+                    await send({"token": token, "text": text})
+            except GenerationError as e:
+                # too late for a status code, the last line carries the error instead of done
+                await send({"error": str(e)})
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+                return
+        await send({"done": True})
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        self._queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batch_loop())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"serving on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a MiniGPT checkpoint over HTTP")
+    parser.add_argument("--checkpoint", type=Path, required=True)
+    parser.add_argument("--quantized", action="store_true", help="checkpoint saved by quantize.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=10.0)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.quantized:
+        model = load_quantized(args.checkpoint, map_location=args.device)
+    else:
+        model = MiniGPT.from_checkpoint(args.checkpoint, map_location=args.device)
+    server = InferenceServer(model, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
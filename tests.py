@@ -1,7 +1,18 @@
+import json
+import tempfile
 from pathlib import Path
 
 import torch
 import numpy as np
+from torch.utils.data import DataLoader
+
+import checkpoint
+from checkpoint import CheckpointManager
+from config import BigramConfig, SamplingConfig
+from dataset import SequentialEvalDataset
+from generation import speculative_generate
+from model import IGNORE_INDEX, BigramLanguageModel
+from sampling import AliasTable, Sampler
 
 
 def check_singleheadattention(model, checkpoint_file, device="cpu"):
@@ -150,6 +161,40 @@ def check_multiheadattention(model, checkpoint_file, device="cpu"):
     return "TEST CASE PASSED!!!"
 
 
+def check_fused_multiheadattention(model, checkpoint_file, device="cpu"):
+
+    model.to(device)
+    model.eval()
+    data_file = "./test_cases.npz"
+    key = "multiheadattention"
+
+    ckpt = torch.load(checkpoint_file, map_location=device)
+
+    # the fused layer loads the per head layout through its state dict adapter
+    prefix = "transformer_layers.0.attention."
+    state_dict = {
+        k[len(prefix) :]: v
+        for k, v in ckpt["model_state_dict"].items()
+        if k.startswith(prefix)
+    }
+    model.load_state_dict(state_dict)
+    assert set(model.state_dict()) >= {
+        "head_0.key.weight",
+        "head_0.query.weight",
+        "head_0.value.weight",
+    }, "TEST CASE FAILED"
+
+    data = np.load(data_file)
+    old_input = torch.from_numpy(data[key + "_input"])
+    old_output = torch.from_numpy(data[key + "_output"])
+    old_input = old_input.to(device)
+    old_output = old_output.to(device)
+    check_output = model(old_input)
+    assert torch.allclose(check_output, old_output, atol=1e-5), "TEST CASE FAILED"
+
+    return "TEST CASE PASSED!!!"
+
+
 def check_feedforward(model, checkpoint_file, device="cpu"):
 
     model.to(device)
@@ -384,3 +429,301 @@ def check_bigram(model, checkpoint_file, device="cpu"):
     assert torch.allclose(check_output, old_output, atol=1e-5), "TEST CASE FAILED"
 
     return "TEST CASE PASSED!!!"
+
+
+def check_kv_cache(model, checkpoint_file, device="cpu"):
+
+    model.to(device)
+    model.eval()
+    data_file = "./test_cases.npz"
+    key = "minigpt"
+
+    ckpt = torch.load(checkpoint_file, map_location=device)
+    model.load_state_dict(ckpt["model_state_dict"])
+
+    data = np.load(data_file)
+    old_input = torch.from_numpy(data[key + "_input"])
+    old_output = torch.from_numpy(data[key + "_output"])
+    old_input = old_input.to(device)
+    old_output = old_output.to(device)
+
+    with torch.no_grad():
+        # prefill with the first token, then feed the rest one token at a time
+        kv_cache = model.init_kv_cache()
+        outputs = [model(old_input[:, :1], kv_cache=kv_cache)]
+        for i in range(1, old_input.size(1)):
+            outputs.append(model(old_input[:, i : i + 1], kv_cache=kv_cache))
+    check_output = torch.cat(outputs, dim=1)
+    assert torch.allclose(check_output, old_output, atol=1e-5), "TEST CASE FAILED"
+
+    return "TEST CASE PASSED!!!"
+
+
+def check_chunked_cross_entropy(model, checkpoint_file, device="cpu"):
+
+    model.to(device)
+    model.eval()
+    data_file = "./test_cases.npz"
+    key = "minigpt"
+
+    ckpt = torch.load(checkpoint_file, map_location=device)
+    model.load_state_dict(ckpt["model_state_dict"])
+
+    data = np.load(data_file)
+    old_input = torch.from_numpy(data[key + "_input"]).to(device)
+    targets = torch.roll(old_input, -1, dims=1)
+
+    # reference: full logits, nn.CrossEntropyLoss
+    logits = model(old_input)
+    loss = torch.nn.functional.cross_entropy(logits.transpose(1, 2), targets)
+    loss.backward()
+    grads = {name: p.grad.clone() for name, p in model.named_parameters()}
+    model.zero_grad()
+
+    # chunks smaller than the number of tokens
+    # the config is shared (usually the MiniGPTConfig class itself), always put it back
+    chunk_size = model.config.loss_chunk_size
+    model.config.loss_chunk_size = 3
+    try:
+        check_loss = model(old_input, targets=targets)
+        check_loss.backward()
+    finally:
+        model.config.loss_chunk_size = chunk_size
+    assert torch.allclose(check_loss, loss, atol=1e-5), "TEST CASE FAILED"
+    for name, p in model.named_parameters():
+        assert torch.allclose(p.grad, grads[name], atol=1e-5), "TEST CASE FAILED"
+    model.zero_grad()
+
+    return "TEST CASE PASSED!!!"
+
+
+def check_sampler(model, checkpoint_file, device="cpu"):
+
+    torch.manual_seed(0)
+    vocab_size = 300  # more than NUCLEUS_INITIAL_CANDIDATES, the nucleus search has to grow
+    configs = [
+        SamplingConfig(),
+        SamplingConfig(temperature=0.7),
+        SamplingConfig(top_k=5),
+        SamplingConfig(top_p=0.9),
+        SamplingConfig(temperature=1.3, top_k=100, top_p=0.95),
+        SamplingConfig(temperature=0.5, top_k=400, top_p=0.999),
+        SamplingConfig(temperature=0.0),
+    ]
+    logits = torch.randn(len(configs), vocab_size, device=device) * 3
+
+    # reference: sort the whole vocabulary, filter on the scaled full distribution
+    expected = torch.zeros_like(logits)
+    for row, c in enumerate(configs):
+        if c.temperature <= 0:
+            expected[row, logits[row].argmax()] = 1.0
+            continue
+        probs = torch.softmax(logits[row] / c.temperature, dim=-1)
+        sorted_probs, order = probs.sort(descending=True)
+        keep = torch.ones_like(sorted_probs, dtype=torch.bool)
+        if c.top_k is not None:
+            keep[c.top_k :] = False
+        if c.top_p is not None:
+            keep &= sorted_probs.cumsum(dim=-1) - sorted_probs < c.top_p
+        kept = torch.where(keep, sorted_probs, torch.zeros_like(sorted_probs))
+        expected[row, order] = kept / kept.sum()
+
+    check_probs = Sampler(configs, device=device).probs(logits)
+    assert torch.allclose(check_probs, expected, atol=1e-5), "TEST CASE FAILED"
+
+    # a seeded row gives the same tokens whatever the other rows are
+    seeded = SamplingConfig(temperature=0.8, top_p=0.9, seed=1234)
+    samplers = [
+        Sampler([seeded, SamplingConfig(top_k=3)], device=device),
+        Sampler([seeded, SamplingConfig(seed=7)], device=device),
+        Sampler([seeded], device=device),
+    ]
+    for _ in range(20):
+        step_logits = torch.randn(2, vocab_size, device=device)
+        tokens = [sampler(step_logits[: len(sampler.generators)])[0] for sampler in samplers]
+        assert all(token == tokens[0] for token in tokens), "TEST CASE FAILED"
+
+    return "TEST CASE PASSED!!!"
+
+
+def check_speculative_decoding(model, checkpoint_file, device="cpu"):
+
+    model.to(device)
+    model.eval()
+    ckpt = torch.load(checkpoint_file, map_location=device)
+    model.load_state_dict(ckpt["model_state_dict"])
+
+    # an untrained draft disagrees with the target, so both acceptance and rejection are exercised
+    torch.manual_seed(0)
+    draft_model = BigramLanguageModel(BigramConfig(vocab_size=model.config.vocab_size)).to(device)
+    ctx = model.context_length
+    prompt = torch.randint(model.config.vocab_size, (ctx - 2,), device=device)
+
+    # greedy: the same tokens as generate, well past the first rollover of the window
+    greedy = SamplingConfig(temperature=0.0)
+    expected = model.generate(prompt, 3 * ctx, sampling=greedy)
+    check_output, _ = speculative_generate(
+        model, draft_model, prompt, 3 * ctx, num_draft_tokens=4, sampling=greedy
+    )
+    assert torch.equal(check_output, expected), "TEST CASE FAILED"
+
+    # sampling: exact distribution of the 3 tokens that cross the window (top-k keeps it small)
+    num_new, num_runs = 3, 2000
+    exact = {(): 1.0}
+    for _ in range(num_new):
+        grown = {}
+        for path, path_prob in exact.items():
+            tokens = torch.cat([prompt, torch.tensor(path, dtype=torch.long, device=device)])
+            with torch.no_grad():
+                logits = model(tokens[-ctx:].unsqueeze(0))[:, -1, :]
+            probs = Sampler(SamplingConfig(top_k=2)).probs(logits)[0]
+            for token in probs.nonzero().squeeze(1).tolist():
+                grown[path + (token,)] = path_prob * float(probs[token])
+        exact = grown
+
+    counts = {}
+    for seed in range(num_runs):
+        output, _ = speculative_generate(
+            model, draft_model, prompt, num_new, num_draft_tokens=2,
+            sampling=SamplingConfig(top_k=2, seed=seed),
+        )
+        path = tuple(output[0, -num_new:].tolist())
+        counts[path] = counts.get(path, 0) + 1
+    assert set(counts) <= set(exact), "TEST CASE FAILED"
+    total_variation = 0.5 * sum(
+        abs(counts.get(path, 0) / num_runs - prob) for path, prob in exact.items()
+    )
+    assert total_variation < 0.06, "TEST CASE FAILED"
+
+    return "TEST CASE PASSED!!!"
+
+
+def check_sequential_eval_dataset(model, checkpoint_file, device="cpu"):
+
+    # every token value is unique, so the scored targets can be counted by value
+    shard_sizes = [103, 58, 6]  # the last shard is too short for a single window
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        shards, first = [], 0
+        for i, num_tokens in enumerate(shard_sizes):
+            np.arange(first, first + num_tokens, dtype=np.uint16).tofile(folder / f"test-{i}.bin")
+            shards.append({"file": f"test-{i}.bin", "num_tokens": num_tokens, "num_documents": 1})
+            first += num_tokens
+        (folder / "manifest.json").write_text(json.dumps({"splits": {"test": shards}}))
+
+        # the targets of a shard are all its tokens but the first
+        expected = np.zeros(first, dtype=np.int64)
+        first = 0
+        for num_tokens in shard_sizes[:2]:
+            expected[first + 1 : first + num_tokens] = 1
+            first += num_tokens
+
+        for stride in [None, 3, 8]:
+            for world_size, num_workers in [(1, 0), (2, 0), (3, 2)]:
+                counts = np.zeros(len(expected), dtype=np.int64)
+                num_targets = 0
+                for rank in range(world_size):
+                    dataset = SequentialEvalDataset(
+                        folder, "test", context_length=8, batch_size=4, stride=stride,
+                        rank=rank, world_size=world_size,
+                    )
+                    loader = DataLoader(dataset, batch_size=None, num_workers=num_workers)
+                    for x, y in loader:
+                        scored = y[y != IGNORE_INDEX].numpy()
+                        counts += np.bincount(scored, minlength=len(expected))
+                        num_targets += len(scored)
+                assert np.array_equal(counts, expected), "TEST CASE FAILED"
+                assert num_targets == dataset.num_targets, "TEST CASE FAILED"
+
+    return "TEST CASE PASSED!!!"
+
+
+def check_checkpoint_manager(model, checkpoint_file, device="cpu"):
+
+    replaced = []
+    os_replace = checkpoint.os.replace
+
+    def record_replace(src, dst):
+        replaced.append((Path(src).name, Path(dst).name))
+        os_replace(src, dst)
+
+    checkpoint.os.replace = record_replace
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            folder = Path(folder)
+            assert CheckpointManager(folder).resume_from_latest() is None, "TEST CASE FAILED"
+
+            manager = CheckpointManager(folder, keep_last=2)
+            weight = torch.zeros(3)
+            metrics = [3.0, 1.0, 2.0, None, 5.0]
+            for step, metric in enumerate(metrics, start=1):
+                weight.fill_(step)
+                manager.save(step, {"step": step, "weight": weight}, metric)
+                weight.fill_(-1)  # the snapshot was taken at save time
+            manager.close()
+
+            # the 2 most recent checkpoints and the best one (step 2)
+            files = sorted(p.name for p in folder.iterdir())
+            expected = [f"checkpoint_{step:08d}.pth" for step in (2, 4, 5)] + ["checkpoints.json"]
+            assert files == sorted(expected), "TEST CASE FAILED"
+            assert manager.best_path.name == "checkpoint_00000002.pth", "TEST CASE FAILED"
+            # every file was written under a temporary name first
+            written = {dst for _, dst in replaced}
+            expected = {f"checkpoint_{step:08d}.pth" for step in range(1, 6)} | {"checkpoints.json"}
+            assert written == expected, "TEST CASE FAILED"
+            assert all(src == dst + ".tmp" for src, dst in replaced), "TEST CASE FAILED"
+
+            # a new manager picks up the index
+            resumed = CheckpointManager(folder, keep_last=2)
+            assert resumed.best_metric == 1.0, "TEST CASE FAILED"
+            state = resumed.resume_from_latest()
+            assert state["step"] == 5, "TEST CASE FAILED"
+            assert torch.equal(state["weight"], torch.full((3,), 5.0)), "TEST CASE FAILED"
+            best = torch.load(resumed.best_path, weights_only=False)
+            assert torch.equal(best["weight"], torch.full((3,), 2.0)), "TEST CASE FAILED"
+            resumed.close()
+
+        with tempfile.TemporaryDirectory() as folder:
+            # keep_last=0 only keeps the best checkpoint
+            manager = CheckpointManager(folder, keep_last=0)
+            for step, metric in enumerate([2.0, 1.0, 3.0], start=1):
+                manager.save(step, {"step": step}, metric)
+            manager.close()
+            assert [c["step"] for c in manager.checkpoints] == [2], "TEST CASE FAILED"
+
+            # tied tensors are saved once and stay tied
+            weight = torch.randn(4, 3)
+            manager = CheckpointManager(folder)
+            manager.save(4, {"embedding": weight, "head": weight.detach(), "other": weight.clone()})
+            state = manager.resume_from_latest()
+            manager.close()
+            assert state["embedding"].data_ptr() == state["head"].data_ptr(), "TEST CASE FAILED"
+            assert state["embedding"].data_ptr() != state["other"].data_ptr(), "TEST CASE FAILED"
+    finally:
+        checkpoint.os.replace = os_replace
+
+    return "TEST CASE PASSED!!!"
+
+
+def check_alias_table(model, checkpoint_file, device="cpu"):
+
+    rng = np.random.default_rng(0)
+    cases = [
+        np.ones(5),  # uniform: no column below 1
+        np.ones(1),
+        np.array([0.0, 0.0, 3.0]),
+        rng.random(1000) ** 4,
+        np.exp(rng.normal(size=50257) * 3),
+    ]
+    for probs in cases:
+        table = AliasTable(probs)
+        n = len(probs)
+        prob = table.prob.astype(np.float64)
+        assert ((prob >= -1e-6) & (prob <= 1 + 1e-6)).all(), "TEST CASE FAILED"
+        # mass of every outcome: its own column plus the columns aliasing to it
+        mass = prob / n
+        np.add.at(mass, table.alias, (1 - prob) / n)
+        assert np.allclose(mass, probs / probs.sum(), atol=1e-6), "TEST CASE FAILED"
+        assert all(0 <= table.sample(u) < n for u in rng.random(100)), "TEST CASE FAILED"
+
+    return "TEST CASE PASSED!!!"
@@ -1,23 +1,21 @@
 """
 Training file for the models we implemented 
+
+Single process:      python train.py
+Data parallel (CPU): torchrun --nproc_per_node 4 train.py
 """
 
 from pathlib import Path
 import torch
-import torch.nn as nn
 import torch.nn.functional as F
-from tqdm import tqdm
-import os
 
-import torch.optim as optim
-import torch.nn.utils
 from torch.utils.data import DataLoader
 from einops import rearrange
-import wandb
 
 from model import BigramLanguageModel, MiniGPT
-from dataset import TinyStoriesDataset
+from dataset import SequentialEvalDataset, TinyStoriesDataset
 from config import BigramConfig, MiniGPTConfig
+from trainer import Trainer, init_distributed, shared_seed
 
 
 MODEL = "minigpt"  # bigram or minigpt
@@ -31,9 +29,13 @@ elif MODEL == "minigpt":
 else:
     raise ValueError("Invalid model name")
 
+# (0, 0, 1) unless launched with torchrun
+rank, local_rank, world_size = init_distributed(config.ddp_backend)
+
+# Initialize wandb if you want to use it, the metrics are written to save_path in any case
+if config.to_log and rank == 0:
+    import wandb
 
-# Initialize wandb if you want to use it
-if config.to_log:
     wandb.init(project="dl2_proj3_minigpt")
 
 
@@ -45,21 +47,35 @@ train_dataset = TinyStoriesDataset(
     config.path_to_data,
     mode="train",
     context_length=config.context_length,
+    batch_size=config.batch_size,
+    seed=shared_seed(config.data_seed),  # every rank samples its share of the same stream
+    packing=getattr(config, "packing", False),
+    rank=rank,
+    world_size=world_size,
 )
-eval_dataset = TinyStoriesDataset(
-    config.path_to_data, mode="test", context_length=config.context_length
+# deterministic pass over the test split, every token scored once
+eval_dataset = SequentialEvalDataset(
+    config.path_to_data,
+    mode="test",
+    context_length=config.context_length,
+    batch_size=config.batch_size,
+    stride=config.eval_stride,
+    rank=rank,
+    world_size=world_size,
 )
 
+# the datasets yield whole batches, no collation needed
 train_dataloader = DataLoader(
-    train_dataset, batch_size=config.batch_size, pin_memory=True
+    train_dataset, batch_size=None, pin_memory=True, num_workers=config.num_workers
 )
 eval_dataloader = DataLoader(
-    eval_dataset, batch_size=config.batch_size, pin_memory=True
+    eval_dataset, batch_size=None, pin_memory=True, num_workers=config.num_workers
 )
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+device = torch.device(f"cuda:{local_rank}" if torch.cuda.is_available() else "cpu")
 
-print("number of trainable parameters: %.2fM" % (count_parameters(model) / 1e6,))
+if rank == 0:
+    print("number of trainable parameters: %.2fM" % (count_parameters(model) / 1e6,))
 
 
 if not Path.exists(config.save_path):
@@ -83,59 +99,8 @@ not a required part of the assignment.
 Feel free to experiment with the parameters and I would be happy to talk to you about them if interested :)
 """
 
-def save_checkpoint(save_path, model, optimizer, dmconfig):
-    save_ckpt = {
-        'model_state_dict': model.state_dict(),
-        'optimizer_state_dict': optimizer.state_dict(),
-        'dmconfig': dmconfig
-    }
-    torch.save(save_ckpt, save_path)
-
-
-optimizer = optim.Adam(model.parameters(), lr=1e-4)
-
-def train_and_test(train_dataloader,eval_dataloader, model, optimizer,device,test_length=1000):
-    model = model.to(device)
-    model.train()
-    criterion = nn.CrossEntropyLoss()
-    for i,(x,y) in enumerate(tqdm(train_dataloader,leave = True, desc = 'training')):
-        x,y = x.to(device),y.to(device)
-        predicted_y = model(x)
-        #y = y.squeeze(1)
-        predicted_y = torch.transpose(predicted_y,1,2)
-        loss = criterion(predicted_y,y)
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        if i%config.log_interval==0:
-          wandb.log({"training loss": loss})
-        if i%config.save_iterations == 0:
-          nth_check_point = str(i//config.save_iterations) + 'save_iterations_checkpoint.pth'
-          save_best_path = os.path.join(config.save_path, nth_check_point)
-          save_checkpoint(save_best_path, model, optimizer, config)
-        if i%1000 == 0:
-          test_loss = test(eval_dataloader=eval_dataloader,model=model,device=device,test_length=test_length)
-          wandb.log({"test loss": test_loss})
-        if i == len(train_dataloader)-1:
-          break
-    return
-
-def test(eval_dataloader,model,device,test_length):
-    model.eval()
-    criterion = nn.CrossEntropyLoss()
-    test_loss = 0
-    with torch.no_grad():
-      for i,(x,y) in enumerate(eval_dataloader):
-        x,y = x.to(device),y.to(device)
-        predicted_y = model(x)
-        predicted_y = torch.transpose(predicted_y,1,2)
-        #y = y.squeeze(1)
-        test_loss += criterion(predicted_y,y).item()
-        predicted_y = None
-        if i==test_length-1:
-          break
-      loss = test_loss/i
-    return loss
-
-
-train_and_test(train_dataloader=train_dataloader,eval_dataloader=eval_dataloader, model=model, optimizer=optimizer,device=device)
\ No newline at end of file
+trainer = Trainer(model, config, train_dataloader, eval_dataloader, device)
+trainer.fit(eval_batches=config.eval_batches, final_eval=config.final_eval)
+
+if torch.distributed.is_initialized():
+    torch.distributed.destroy_process_group()
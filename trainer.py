@@ -0,0 +1,347 @@
+"""
+Config driven training loop shared by the bigram and MiniGPT models.
+
+Launched with torchrun the Trainer runs distributed data parallel: every rank trains a replica
+on its own slice of the data stream, gradients are averaged by DistributedDataParallel, and only
+rank 0 logs and saves checkpoints.
+"""
+
+import dataclasses
+import math
+import os
+import time
+from contextlib import nullcontext
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+from tqdm import tqdm
+
+from checkpoint import CheckpointManager, rng_state, set_rng_state
+from dataset import IGNORE_INDEX, DevicePrefetcher
+from metrics import MetricsLogger, PhaseTimer, peak_memory_mb
+
+
+def warmup_cosine(step, warmup_iters, max_iter, min_ratio=0.0):
+    """
+    Learning rate multiplier: linear warmup from 0 over warmup_iters steps, then cosine decay
+    down to min_ratio at max_iter.
+    """
+    if step < warmup_iters:
+        return (step + 1) / warmup_iters
+    progress = min((step - warmup_iters) / max(max_iter - warmup_iters, 1), 1.0)
+    return min_ratio + (1 - min_ratio) * 0.5 * (1 + math.cos(math.pi * progress))
+
+
+def init_distributed(backend="gloo"):
+    """
+    Join the process group when launched with torchrun (WORLD_SIZE > 1).
+
+    On CPU torchrun limits every rank to one intra-op thread, the cores of the host are split
+    between its ranks instead.
+
+    Output:
+    Tuple[int, int, int]
+        rank, local_rank and world_size, (0, 0, 1) for a single process.
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+    if not torch.cuda.is_available():
+        torch.set_num_threads(max(os.cpu_count() // local_world_size, 1))
+    return dist.get_rank(), int(os.environ.get("LOCAL_RANK", 0)), world_size
+
+
+def shared_seed(seed=None):
+    """seed, or a random seed drawn by rank 0 and broadcast so every rank samples the same stream."""
+    if seed is not None or not dist.is_initialized():
+        return seed
+    seed = [int(np.random.SeedSequence().entropy % 2**63)]
+    dist.broadcast_object_list(seed, src=0)
+    return seed[0]
+
+
+def flat_logits_targets(logits, targets):
+    """
+    (num_tokens, vocab_size) float logits and (num_tokens,) targets for the cross entropy, from the
+    (batch_size, seq_len, vocab_size) logits of MiniGPT or the (batch_size, vocab_size) ones of
+    BigramLanguageModel (whose targets are (batch_size, 1)).
+    """
+    return logits.float().reshape(-1, logits.size(-1)), targets.reshape(-1)
+
+
+class Trainer:
+    def __init__(self, model, config, train_dataloader, eval_dataloader=None, device="cpu"):
+        """
+        Train model with the settings of config (a BigramConfig or MiniGPTConfig):
+
+        - Adam with config.learning_rate, fused on CUDA and foreach otherwise.
+        - config.scheduler: linear warmup over config.warmup_iters steps then cosine decay to
+          config.min_learning_rate at config.max_iter.
+        - config.to_clip_grad: clip the gradient norm to config.gradient_clip.
+        - config.gradient_accumulation_steps micro batches per optimizer step, the effective
+          batch size is batch_size * gradient_accumulation_steps.
+        - config.precision autocast (MiniGPT only), with a GradScaler for fp16.
+        - config.compile_mode: torch.compile the training forward with that mode.
+
+        Every log_interval steps the loss, learning rate, time per phase (data, forward, backward,
+        optimizer, checkpoint), tokens/s and peak memory are recorded, along with the eval loss
+        and duration, to config.save_path / config.metrics_file (.jsonl or .csv) and to wandb
+        with config.to_log.
+
+        Iterations (log_interval, save_iterations, eval_interval, max_iter) count optimizer steps.
+
+        Checkpoints (model, optimizer, scheduler, scaler, RNG and data sampler states) are written
+        to config.save_path in the background every save_iterations steps, and whenever the eval
+        loss improves, keeping the last config.keep_checkpoints and the best one. With
+        config.resume, fit() first restores the latest of them.
+
+        When the default process group is initialized (see init_distributed) the model is wrapped
+        in DistributedDataParallel, the datasets should be built with the rank and world size.
+        """
+        self.config = config
+        self.device = torch.device(device)
+        self.distributed = dist.is_initialized() and dist.get_world_size() > 1
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        self.is_main = self.rank == 0
+        self.raw_model = model.to(self.device)
+        self.model = self.raw_model
+        if self.distributed:
+            self.model = DistributedDataParallel(
+                self.raw_model, device_ids=[self.device] if self.device.type == "cuda" else None
+            )
+        if getattr(config, "compile_mode", None):
+            # training batches all have the same shape, one graph (see compiled.py for bucketing)
+            self.model = torch.compile(self.model, mode=config.compile_mode, dynamic=False)
+        self.train_dataloader = train_dataloader
+        self.eval_dataloader = eval_dataloader
+        self.accumulation_steps = max(getattr(config, "gradient_accumulation_steps", 1), 1)
+        self.step = 0
+        self.tokens = 0  # input tokens of this rank since the last log
+        self.resumed_step = 0  # step the data sampler state was restored at
+        self.checkpoints = CheckpointManager(config.save_path, config.keep_checkpoints)
+        self.timer = PhaseTimer(self.device, getattr(config, "sync_timing", False))
+        self.metrics = MetricsLogger(
+            Path(config.save_path) / config.metrics_file if self.is_main else None,
+            use_wandb=config.to_log and self.is_main,
+        )
+
+        fused = self.device.type == "cuda"
+        self.optimizer = optim.Adam(
+            model.parameters(),
+            lr=config.learning_rate,
+            fused=fused,
+            foreach=None if fused else True,
+        )
+        self.scheduler = None
+        if config.scheduler:
+            self.scheduler = optim.lr_scheduler.LambdaLR(
+                self.optimizer,
+                lambda step: warmup_cosine(
+                    step,
+                    config.warmup_iters,
+                    config.max_iter,
+                    config.min_learning_rate / config.learning_rate,
+                ),
+            )
+        # fp16 gradients underflow without loss scaling, the scaler is a no-op otherwise
+        self.scaler = torch.amp.GradScaler(
+            self.device.type, enabled=getattr(config, "precision", "fp32") == "fp16"
+        )
+        self.criterion = nn.CrossEntropyLoss()
+        # MiniGPT computes the head and the loss in chunks itself when given the targets
+        self.chunked_loss = bool(getattr(config, "loss_chunk_size", None))
+
+    def forward(self, batch, **kwargs):
+        """Logits of a batch, (x, y) or packed (x, y, position_ids, segment_ids)."""
+        if len(batch) == 4:
+            # packed documents: positions restart and attention stops at every document
+            return self.model(batch[0], position_ids=batch[2], segment_ids=batch[3], **kwargs)
+        return self.model(batch[0], **kwargs)
+
+    def compute_loss(self, batch):
+        if self.chunked_loss:
+            # through self.model so that DistributedDataParallel sees the forward pass
+            return self.forward(batch, targets=batch[1])
+        logits = self.forward(batch)
+        return self.criterion(*flat_logits_targets(logits, batch[1]))
+
+    def train_step(self, batches):
+        """One optimizer step over the next accumulation_steps batches, returns the mean loss."""
+        self.model.train()
+        total = 0.0
+        for j in range(self.accumulation_steps):
+            with self.timer.phase("data"):
+                batch = next(batches)
+            self.tokens += batch[0].numel()
+            # gradients are only all-reduced on the last micro batch
+            last = j == self.accumulation_steps - 1
+            with self.model.no_sync() if self.distributed and not last else nullcontext():
+                with self.timer.phase("forward"):
+                    loss = self.compute_loss(batch) / self.accumulation_steps
+                with self.timer.phase("backward"):
+                    self.scaler.scale(loss).backward()
+            total += loss.detach()
+        with self.timer.phase("optimizer"):
+            if self.config.to_clip_grad:
+                self.scaler.unscale_(self.optimizer)
+                nn.utils.clip_grad_norm_(self.model.parameters(), self.config.gradient_clip)
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            self.optimizer.zero_grad(set_to_none=True)
+            if self.scheduler is not None:
+                self.scheduler.step()
+        self.step += 1
+        return total
+
+    def all_reduce(self, tensor):
+        """Sum of tensor over the ranks (tensor itself for a single process)."""
+        if self.distributed:
+            dist.all_reduce(tensor)
+        return tensor
+
+    @torch.no_grad()
+    def evaluate(self, max_batches=None):
+        """
+        Token weighted mean loss over the first max_batches eval batches (all of them if None),
+        of every rank when distributed.
+        """
+        self.raw_model.eval()
+        # summed over the scored targets, divided by their count at the end
+        criterion = nn.CrossEntropyLoss(ignore_index=IGNORE_INDEX, reduction="sum")
+        total = torch.zeros((), dtype=torch.float64, device=self.device)
+        num_targets = torch.zeros((), dtype=torch.float64, device=self.device)
+        for i, (x, y) in enumerate(self.eval_dataloader):
+            if i == max_batches:
+                break
+            x, y = x.to(self.device), y.to(self.device)
+            if self.chunked_loss:
+                total += self.raw_model(x, targets=y, reduction="sum")
+            else:
+                logits = self.raw_model(x)
+                total += criterion(*flat_logits_targets(logits, y))
+            num_targets += (y != IGNORE_INDEX).sum()
+        self.raw_model.train()
+        totals = self.all_reduce(torch.stack([total, num_targets]))
+        return (totals[0] / totals[1]).item()
+
+    def state_dict(self):
+        """Everything needed to resume training exactly, see load_state_dict."""
+        dataset = self.train_dataloader.dataset
+        sampler_state = None
+        if hasattr(dataset, "state_dict"):
+            consumed = (self.step - self.resumed_step) * self.accumulation_steps
+            sampler_state = dataset.state_dict(consumed=consumed)
+        return {
+            "step": self.step,
+            "model_state_dict": self.raw_model.state_dict(),
+            "optimizer_state_dict": self.optimizer.state_dict(),
+            "scheduler_state_dict": self.scheduler.state_dict() if self.scheduler else None,
+            "scaler_state_dict": self.scaler.state_dict(),
+            "sampler_state": sampler_state,
+            "rng_state": rng_state(),
+            # plain values, not the config class
+            "config": {f.name: getattr(self.config, f.name) for f in dataclasses.fields(self.config)},
+        }
+
+    def load_state_dict(self, state):
+        """Restore a state_dict, before fit() creates the data iterator."""
+        self.raw_model.load_state_dict(state["model_state_dict"])
+        self.optimizer.load_state_dict(state["optimizer_state_dict"])
+        if self.scheduler is not None and state["scheduler_state_dict"] is not None:
+            self.scheduler.load_state_dict(state["scheduler_state_dict"])
+        self.scaler.load_state_dict(state["scaler_state_dict"])
+        dataset = self.train_dataloader.dataset
+        if state["sampler_state"] is not None and hasattr(dataset, "load_state_dict"):
+            dataset.load_state_dict(state["sampler_state"])
+        set_rng_state(state["rng_state"])
+        self.step = self.resumed_step = state["step"]
+
+    def save_checkpoint(self, metric=None):
+        if self.is_main:
+            with self.timer.phase("checkpoint"):
+                self.checkpoints.save(self.step, self.state_dict(), metric)
+
+    def log(self, metrics):
+        if self.is_main:
+            self.metrics.log(metrics, self.step)
+
+    def step_metrics(self, loss, num_steps, elapsed):
+        """Loss, learning rate, mean seconds per phase and throughput over the last num_steps steps."""
+        metrics = {"training loss": loss, "learning rate": self.optimizer.param_groups[0]["lr"]}
+        for phase, seconds in self.timer.pop().items():
+            metrics[f"{phase} time (s)"] = seconds / num_steps
+        metrics["step time (s)"] = elapsed / num_steps
+        # every rank processes as many tokens
+        metrics["tokens/s"] = self.tokens * self.world_size / elapsed
+        metrics["peak memory (MB)"] = peak_memory_mb(self.device)
+        self.tokens = 0
+        return metrics
+
+    def evaluate_and_log(self, max_batches=None, prefix=""):
+        """evaluate(max_batches) on every rank, log it and save a checkpoint if it is the best."""
+        start = time.perf_counter()
+        test_loss = self.evaluate(max_batches)
+        eval_time = time.perf_counter() - start
+        self.log(
+            {
+                f"{prefix}test loss": test_loss,
+                f"{prefix}test perplexity": math.exp(test_loss),
+                f"{prefix}eval time (s)": eval_time,
+            }
+        )
+        if test_loss < self.checkpoints.best_metric:
+            self.save_checkpoint(metric=test_loss)
+        return test_loss
+
+    def fit(self, max_iter=None, eval_batches=None, final_eval=False):
+        """
+        Train for max_iter optimizer steps (config.max_iter by default), logging, saving and
+        evaluating every config.log_interval / save_iterations / eval_interval steps.
+
+        The periodic evaluations only score the first eval_batches batches (all of them if None),
+        final_eval adds a full pass over the eval set at the end.
+        """
+        config = self.config
+        max_iter = max_iter or config.max_iter
+        if config.resume:
+            state = self.checkpoints.resume_from_latest()
+            if state is not None:
+                self.load_state_dict(state)
+                if self.is_main:
+                    print(f"resumed from {self.checkpoints.latest_path} at step {self.step}")
+        # the next batches are copied to the device while the current step runs
+        prefetcher = DevicePrefetcher(
+            self.train_dataloader, self.device, getattr(config, "prefetch_batches", 2)
+        )
+        batches = iter(prefetcher)
+
+        steps = range(self.step, max_iter)
+        last_log, last_log_step = time.perf_counter(), self.step
+        for i in tqdm(steps, leave=True, desc="training", disable=not self.is_main):
+            loss = self.train_step(batches)
+            if i % config.save_iterations == 0:
+                self.save_checkpoint()
+            if i % config.log_interval == 0:
+                # the loss stays a tensor, it is only read when the metrics are written
+                loss = self.all_reduce(loss) / self.world_size
+                now = time.perf_counter()
+                self.log(self.step_metrics(loss, self.step - last_log_step, now - last_log))
+                last_log, last_log_step = now, self.step
+            if self.eval_dataloader is not None and i % config.eval_interval == 0:
+                start = time.perf_counter()
+                self.evaluate_and_log(eval_batches)
+                # evaluation is not part of the training throughput
+                last_log += time.perf_counter() - start
+        if self.eval_dataloader is not None and final_eval:
+            self.evaluate_and_log(None, prefix="final ")
+        self.checkpoints.close()
+        self.metrics.close()